@@ -7,49 +7,209 @@
 #  Copyright 2011 Brian Baughman. All rights reserved.
 ################################################################################
 from os import environ
-from time import sleep
+from time import sleep, time
 
 try:
   bitlyapi = environ['BITLYAPI']
 except:
   homedir = environ['HOME']
   bitlyapi = '%s/.bitlyapi'%homedir
+# Cache of shortened URLs
+try:
+  bitlycache = environ['BITLYCACHE']
+except:
+  bitlycache = '%s/.bitlycache.db'%environ['HOME']
+# Seconds a short URL is used before asking again
+try:
+  bitlyttl = float(environ['BITLYTTL'])
+except:
+  bitlyttl = 30*86400.
+# Seconds the long URL is used after failing to shorten it
+try:
+  bitlynegttl = float(environ['BITLYNEGTTL'])
+except:
+  bitlynegttl = 3600.
+# Seconds to wait, in all, for URLs shortened in the background before exiting
+try:
+  bitlywait = float(environ['BITLYWAIT'])
+except:
+  bitlywait = 10.
+# Shortening service, given the long URL, login and API key
+try:
+  bitlyfmt = environ['BITLYURL']
+except:
+  bitlyfmt = 'http://api.j.mp/shorten?version=2.0.1&longUrl=%s&login=%s&apiKey=%s'
 
 try:
-  import re, urllib2
+  import re, urllib2, threading
+  from sql_interface import GetConfig, baseentry
   bitlyre = re.compile('"shortCNAMEUrl":\s*"([^"]+)"')
-  bitlyfmt = 'http://api.j.mp/shorten?version=2.0.1&longUrl=%s&login=%s&apiKey=%s'
 
   bitlyapif = open(bitlyapi,'r')
   busr,bapi = bitlyapif.readlines()
   busr = busr.strip()
   bapi = bapi.strip()
   bitlyapif.close()
-  
-  def shorten(longurl):
+
+  class shortinfo(baseentry):
+    '''
+      Short URL of longurl, empty if shortening failed, as of updated
+    '''
+    def __init__(self):
+      self.id = "null"
+      self.longurl = "unset"
+      self.shorturl = "unset"
+      self.updated = 0.
+      self.setDBType()
+
+  # Lookups running in the background keyed on long URL
+  pending = {}
+  # Configuration of the cache of each thread, see GetShortConfig
+  cachelocal = threading.local()
+
+  def GetShortConfig():
+    '''
+      Returns the configuration of the cache, opened the first time a thread
+      needs it and then kept, or None if it cannot be opened
+    '''
+    cfg = getattr(cachelocal,'cfg',None)
+    if cfg == None:
+      cfg = GetConfig(bitlycache,"shorturls",shortinfo,["shorturl","updated"],
+                      ["longurl"])
+      cachelocal.cfg = cfg
+    return cfg
+
+  def CloseShortConfig():
+    '''
+      Closes the cache opened by this thread, if any
+    '''
+    cfg = getattr(cachelocal,'cfg',None)
+    cachelocal.cfg = None
+    if cfg != None:
+      cfg.dbconn.close()
+
+  def CachedShort(longurl):
+    '''
+      Returns the cached short URL, the long URL if shortening it failed
+      recently or None if it should be shortened
+    '''
+    cfg = GetShortConfig()
+    if cfg == None:
+      return None
+    cfg.curs.execute(cfg.ckstr,(longurl,))
+    row = cfg.curs.fetchone()
+    if row == None:
+      return None
+    surl = row[cfg.dbstruct['shorturl']['index']]
+    age = time() - row[cfg.dbstruct['updated']['index']]
+    if surl == '':
+      if age < bitlynegttl:
+        return longurl
+      return None
+    if age < bitlyttl:
+      return surl
+    return None
+
+  def CacheShort(longurl,surl):
+    '''
+      Stores the short URL of longurl, an empty one if shortening failed
+    '''
+    cfg = GetShortConfig()
+    if cfg == None:
+      return
+    cstr = "INSERT OR REPLACE INTO %s (longurl,shorturl,updated)"%cfg.dbname
+    cfg.curs.execute("%s VALUES (?,?,?);"%cstr,(longurl,surl,time()))
+    cfg.dbconn.commit()
+
+  def Lookup(longurl):
     '''
       Shortens URLs using bitly's service
       If an error occurs contacting bitly it will try a total of 5 times waiting
-      5 seconds between each
+      5 seconds between each. Returns None if it fails.
     '''
     burl = bitlyfmt%(longurl,busr,bapi)
     for i in xrange(5):
       bitlyraw = None
       try:
-        response = urllib2.urlopen(burl)
+        response = urllib2.urlopen(burl,timeout=10)
         bitlyraw = response.read()
         response.close()
         break
       except:
         sleep(5)
     try:
-      surl = bitlyre.findall(bitlyraw)[0]
-      return surl
+      return bitlyre.findall(bitlyraw)[0]
     except:
+      return None
+
+  def Refresh(longurl):
+    '''
+      Shortens longurl and caches the result
+    '''
+    surl = Lookup(longurl)
+    if surl == None:
+      CacheShort(longurl,'')
       return longurl
+    CacheShort(longurl,surl)
+    return surl
+
+  def Background(longurl):
+    '''
+      Refreshes longurl in a thread of its own, closing the cache it opened
+    '''
+    try:
+      Refresh(longurl)
+    finally:
+      CloseShortConfig()
+
+  def shorten(longurl,background=True):
+    '''
+      Returns the cached short URL. Otherwise, with background set, the long
+      URL is returned at once and shortened in a separate thread for next
+      time, or it is shortened before returning.
+    '''
+    try:
+      surl = CachedShort(longurl)
+    except:
+      surl = None
+    if surl != None:
+      return surl
+    if not background:
+      return Refresh(longurl)
+    Prune()
+    if longurl not in pending:
+      # Not holding up the exit of the process, see flush
+      pending[longurl] = threading.Thread(target=Background,args=(longurl,))
+      pending[longurl].daemon = True
+      pending[longurl].start()
+    return longurl
+
+  def Prune():
+    '''
+      Forgets the lookups which finished, so pending does not grow in long
+      running processes
+    '''
+    for longurl in [ longurl for longurl, cthread in pending.items() \
+                     if not cthread.is_alive() ]:
+      del pending[longurl]
+
+  def flush(timeout=bitlywait):
+    '''
+      Waits up to timeout seconds, in all, for the URLs being shortened in the
+      background, so they are cached before the process exits. Returns the
+      number still running.
+    '''
+    end = time() + timeout
+    for cthread in pending.values():
+      cthread.join(max(end - time(),0.))
+    Prune()
+    return len(pending)
 except:
   '''
     If bitly cannot be loaded do not shorten URLs
   '''
-  def shorten(longurl):
-    return longurl
\ No newline at end of file
+  def shorten(longurl,background=True):
+    return longurl
+
+  def flush(timeout=bitlywait):
+    return 0
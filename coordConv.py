@@ -8,7 +8,7 @@
 ################################################################################
 from os import environ
 from numpy import floor, sin, cos, tan, arcsin, arccos, arctan2, pi, remainder
-from timeConv import dttm2LST
+from timeConv import dttm2LST, tjd2LST
 
 def eq2horz(obslat,obslon,doi,RA,dec):
   '''
@@ -25,6 +25,23 @@ def eq2horz(obslat,obslon,doi,RA,dec):
   dec - declination of event
   '''
   LST = dttm2LST(doi,obslon)
+  return LST2horz(obslat,LST,RA,dec)
+
+def eq2horzTJD(obslat,obslon,tjd,RA,dec):
+  '''
+  As eq2horz but the event time is given as a truncated Julian day. tjd, RA
+  and dec may be numpy arrays, in which case arrays are returned. The
+  altitude, and azimuth times cos(altitude), agree with eq2horz to better
+  than 1e-8 radians (azimuth itself is ill defined at the zenith).
+  '''
+  LST = tjd2LST(tjd,obslon)
+  return LST2horz(obslat,LST,RA,dec)
+
+def LST2horz(obslat,LST,RA,dec):
+  '''
+  Returns the Horizontal Geocentric Coordinates given the observer latitude,
+  the local sidereal time in hours and the RA and dec. Angles in radians.
+  '''
   H = 2.*pi*remainder(LST,24.)/24. - RA
   sinalt = sin(dec)*sin(obslat) + cos(dec)*cos(obslat)*cos(H)
   alt = arcsin(sinalt)
@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+################################################################################
+#  gcn-alertd.py
+#  Resident replacement for running site-alerter from every gcn-parser. Waits
+#  for GCN changed events (see gcn_events.py) and runs the site alerter, in
+#  process, once for all the events arriving together.
+################################################################################
+try:
+  import sys, re, time, logging, traceback
+  from daemon import runner
+  from os import environ, path, _exit, devnull
+except:
+  print 'Failed to load base modules'
+  sys.exit(-1)
+
+try:
+  from gcn_events import gcnalertsock, Listen, Events
+  from site_alerter import SiteAlerter
+  # Home directory
+  homedir = environ['HOME']
+  # stop if something looks wrong
+except:
+  print 'Failed to load modules'
+  _exit(-1)
+
+################################################################################
+# Environment Setup
+################################################################################
+try:
+  gcnalertdlog = environ['GCNALERTDLOG']
+except:
+  gcnalertdlog = '%s/logs/gcn-alertd.log'%homedir
+
+try:
+  gcnalertdlock = environ['GCNALERTDLOCK']
+except:
+  gcnalertdlock = '/tmp/gcn-alertd.lock'
+
+# Seconds to gather further events after the first
+try:
+  gcnalertdelay = float(environ['GCNALERTDELAY'])
+except:
+  gcnalertdelay = 1.
+
+# Seconds after which site-alerter is run without events, e.g. to retry
+# queued emails
+try:
+  gcnalertinter = float(environ['GCNALERTINTER'])
+except:
+  gcnalertinter = 300.
+
+################################################################################
+# App to run
+################################################################################
+
+class App():
+  def __init__(self,log=devnull,sockname=None,delay=1.,inter=300.,
+               pidfile='/tmp/gcn-alertd.lock'):
+    self.stdin_path = '/dev/null'
+    self.stdout_path = log
+    self.stderr_path = log
+    self.pidfile_path =  pidfile
+    self.pidfile_timeout = 5
+    self.umask = 0022
+    self.log = log
+    self.sockname = sockname
+    self.delay = delay
+    self.inter = inter
+    self.srv = None
+    self.alerter = None
+
+  def run(self):
+    logging.basicConfig(filename=self.log,\
+                        format='%(asctime)s %(levelname)s: %(message)s',\
+                        filemode='a', level=logging.DEBUG)
+    self.srv = Listen(self.sockname)
+    self.alerter = SiteAlerter()
+    logging.info('Listening on %s'%self.sockname)
+    while True:
+      self.Check()
+
+  def Check(self):
+    '''
+      Waits for events then runs site-alerter once for all of them
+    '''
+    events = Events(self.srv,self.inter,self.delay)
+    for id, trigid, trig_tjd in events:
+      logging.debug('GCN changed: %i %s %s'%(id,trigid,trig_tjd))
+    logging.info('Updating Site for %i events'%len(events))
+    if self.alerter.dbcfg == None:
+      status = self.alerter.Open()
+      if status != 0:
+        logging.error('site-alerter failed to start: %i'%status)
+        self.alerter.Close()
+        return
+    try:
+      self.alerter.Run()
+    except:
+      # Start again from fresh connections next time
+      logging.error('site-alerter failed:\n%s'%traceback.format_exc())
+      self.alerter.Close()
+
+
+# Start daemon
+if __name__ == "__main__":
+  app = App(log=gcnalertdlog,sockname=gcnalertsock,delay=gcnalertdelay,
+            inter=gcnalertinter,pidfile=gcnalertdlock)
+  daemon_runner = runner.DaemonRunner(app)
+  daemon_runner.daemon_context.files_preserve=[gcnalertdlog]
+  daemon_runner.do_action();
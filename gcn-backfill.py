@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+################################################################################
+#  gcn-backfill.py
+#  Loads archived GCN emails from mbox files or Maildir directories into the
+#  GCN DB. Notices are parsed as a stream, optionally by a pool of processes,
+#  and written in large batches by this process alone.
+################################################################################
+try:
+  import sys, logging, mailbox, multiprocessing
+  from optparse import OptionParser
+  from os import environ, path, _exit
+except:
+  print 'Failed to load base modules'
+  sys.exit(-1)
+try:
+  from gcn_dbinterface import GetGCNConfig, GetGCNKeys, AddGCNs, gcnfields
+  from gcn_notice import NoticeRow
+  # Home directory
+  homedir = environ['HOME']
+  # stop if something looks wrong
+except:
+  print 'Failed to load modules'
+  _exit(-1)
+
+################################################################################
+# Useful functions
+################################################################################
+def Messages(fname):
+  '''
+    Yields the raw text of every message in the mbox file or Maildir given
+  '''
+  if path.isdir(fname):
+    box = mailbox.Maildir(fname,factory=None,create=False)
+  else:
+    box = mailbox.mbox(fname,factory=None,create=False)
+  for key in box.iterkeys():
+    yield box.get_string(key)
+  box.close()
+
+def Archives(fnames):
+  '''
+    Yields the raw text of every message in all the archives given
+  '''
+  for fname in fnames:
+    logging.info('Reading %s'%fname)
+    for indata in Messages(fname):
+      yield indata
+
+def Notices(fnames,jobs=1,chunksize=64):
+  '''
+    Yields a row (see GCNRow) for every parsable notice in the archives given.
+    With jobs > 1 the notices are parsed by a pool of processes, the rows are
+    still yielded here in archive order.
+  '''
+  pool = None
+  if jobs > 1:
+    pool = multiprocessing.Pool(jobs)
+    parsed = pool.imap(NoticeRow,Archives(fnames),chunksize)
+  else:
+    parsed = (NoticeRow(indata) for indata in Archives(fnames))
+  for row, perr in parsed:
+    if row == None:
+      logging.debug(perr)
+      continue
+    yield row
+  if pool != None:
+    pool.close()
+    pool.join()
+
+def LogRejects(rejects):
+  '''
+    Logs the rows refused by AddGCNs, returns how many there were
+  '''
+  for row, err in rejects:
+    logging.warning('Rejected %s: %s'%(dict(zip(gcnfields,row)),err))
+  return len(rejects)
+
+if __name__ == "__main__":
+  parser = OptionParser(usage='%prog [options] ARCHIVE [ARCHIVE ...]')
+  parser.add_option('-b','--batch',dest='batch',type='int',default=10000,
+                    help='Number of notices written per transaction')
+  parser.add_option('-j','--jobs',dest='jobs',type='int',
+                    default=multiprocessing.cpu_count(),
+                    help='Number of processes used to parse notices')
+  parser.add_option('-v','--verbose',dest='verbose',action='store_true',
+                    default=False,help='Log notices which cannot be parsed')
+  (opts,args) = parser.parse_args()
+  if len(args) == 0:
+    parser.error('No archives given')
+
+  # GCN database
+  try:
+    gcndbfname = environ['GCNDB']
+  except:
+    gcndbfname = '%s/gcns.db'%homedir
+  try:
+    gcndbname = environ['GCNDBNAME']
+  except:
+    gcndbname = "gcns"
+
+  if opts.verbose:
+    loglevel = logging.DEBUG
+  else:
+    loglevel = logging.INFO
+  logging.basicConfig(format='%(asctime)s %(levelname)s: %(message)s',\
+                      level=loglevel)
+
+  dbcfg = GetGCNConfig(gcndbfname,gcndbname,"bulk")
+  if dbcfg == None:
+    logging.error('GCN DB failed to initialize.')
+    _exit(-1)
+  known = GetGCNKeys(dbcfg)
+  logging.info('%i GCNs already in %s'%(len(known),gcndbfname))
+
+  nread = 0
+  ninst = 0
+  nupd = 0
+  nrej = 0
+  rows = []
+  for row in Notices(args,opts.jobs):
+    rows.append(row)
+    if len(rows) >= opts.batch:
+      rejects = []
+      ni, nu = AddGCNs(rows,dbcfg,known,rejects=rejects)
+      nread += len(rows)
+      ninst += ni
+      nupd += nu
+      nrej += LogRejects(rejects)
+      rows = []
+      logging.info('Read %i notices: %i new, %i updated, %i rejected'%\
+                   (nread,ninst,nupd,nrej))
+  rejects = []
+  ni, nu = AddGCNs(rows,dbcfg,known,rejects=rejects)
+  nread += len(rows)
+  ninst += ni
+  nupd += nu
+  nrej += LogRejects(rejects)
+  logging.info('Read %i notices: %i new, %i updated, %i rejected'%\
+               (nread,ninst,nupd,nrej))
+
+  dbcfg.curs.close()
+  dbcfg.dbconn.close()
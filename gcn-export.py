@@ -0,0 +1,45 @@
+#!/usr/bin/env python
+################################################################################
+#  gcn-export.py
+#  Writes the GCNs changed after the given change of the GCN DB to stdout, see
+#  ExportGCNs. Run over ssh by site-alerter-daemon to update its replica.
+################################################################################
+try:
+  import sys
+  from os import environ, _exit
+except:
+  print 'Failed to load base modules'
+  sys.exit(-1)
+try:
+  from gcn_dbinterface import GetGCNConfig, ExportGCNs
+  # Home directory
+  homedir = environ['HOME']
+  # stop if something looks wrong
+except:
+  print 'Failed to load modules'
+  _exit(-1)
+
+if __name__ == "__main__":
+  # GCN database
+  try:
+    gcndbfname = environ['GCNDB']
+  except:
+    gcndbfname = '%s/gcns.db'%homedir
+  try:
+    gcndbname = environ['GCNDBNAME']
+  except:
+    gcndbname = "gcns"
+  try:
+    afterseq = int(sys.argv[1])
+  except:
+    sys.stderr.write('Usage: %s LASTCHANGE\n'%sys.argv[0])
+    _exit(-2)
+
+  dbcfg = GetGCNConfig(gcndbfname,gcndbname,"reader")
+  if dbcfg == None:
+    sys.stderr.write('GCN DB failed to initialize.\n')
+    _exit(-1)
+  ExportGCNs(dbcfg,afterseq,sys.stdout)
+  sys.stdout.flush()
+  dbcfg.dbconn.close()
+  _exit(0)
@@ -0,0 +1,83 @@
+#!/usr/bin/env python
+################################################################################
+#  gcn-ingest.py
+#  Thin client to replace gcn-parser.py in the procmail hook. Hands the email
+#  on stdin to gcn-ingestd over its Unix socket, or drops it into the spool
+#  directory if the daemon cannot be reached.
+################################################################################
+try:
+  import sys, socket
+  from os import environ, path, _exit, getpid, rename
+  from time import time
+  # Home directory
+  homedir = environ['HOME']
+except:
+  print 'Failed to load base modules'
+  sys.exit(-1)
+
+# Exit code asking procmail to retry the delivery later (EX_TEMPFAIL)
+tempfail = 75
+
+def Send(sockname,indata,timeout=30.):
+  '''
+    Sends the email to gcn-ingestd and returns its reply
+  '''
+  conn = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+  conn.settimeout(timeout)
+  conn.connect(sockname)
+  conn.sendall(indata)
+  conn.shutdown(socket.SHUT_WR)
+  chunks = []
+  while True:
+    chunk = conn.recv(4096)
+    if not chunk:
+      break
+    chunks.append(chunk)
+  conn.close()
+  return ''.join(chunks)
+
+def Spool(spool,indata):
+  '''
+    Writes the email to the spool directory so gcn-ingestd picks it up later.
+    The file is renamed into place so it is never read half written.
+  '''
+  fname = '%.6f.%i'%(time(),getpid())
+  tmpfname = '%s/tmp/%s'%(spool,fname)
+  fout = open(tmpfname,'w')
+  fout.write(indata)
+  fout.close()
+  rename(tmpfname,'%s/new/%s'%(spool,fname))
+
+if __name__ == "__main__":
+  try:
+    gcningestsock = environ['GCNINGESTSOCK']
+  except:
+    gcningestsock = '%s/.gcn-ingest.sock'%homedir
+  try:
+    gcnspool = environ['GCNSPOOL']
+  except:
+    gcnspool = '%s/gcn-spool'%homedir
+
+  indata = sys.stdin.read()
+  try:
+    reply = Send(gcningestsock,indata)
+  except:
+    reply = None
+  if reply:
+    if reply.startswith('OK'):
+      _exit(0)
+    # The daemon could not store the email for now
+    if reply.startswith('TEMPFAIL'):
+      sys.stderr.write(reply)
+      _exit(tempfail)
+    # The daemon read the email but could not use it
+    sys.stderr.write(reply)
+    _exit(-2)
+  if path.isdir('%s/new'%gcnspool):
+    try:
+      Spool(gcnspool,indata)
+      _exit(0)
+    except:
+      pass
+  sys.stderr.write('gcn-ingestd unavailable\n')
+  _exit(tempfail)
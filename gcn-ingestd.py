@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+################################################################################
+#  gcn-ingestd.py
+#  Long running replacement for calling gcn-parser.py once per email. Accepts
+#  raw GCN emails over a local Unix socket (see gcn-ingest.py) or from a spool
+#  directory and adds them to the GCN DB using a single warm configuration.
+################################################################################
+try:
+  import sys, re, time, logging, traceback, socket
+  from select import select
+  from daemon import runner
+  from os import environ, path, _exit, makedirs, stat, devnull, listdir,\
+    unlink, rename
+  from subprocess import check_output, STDOUT
+  pathname = path.dirname(sys.argv[0])
+except:
+  print 'Failed to load base modules'
+  sys.exit(-1)
+
+try:
+  from gcn_dbinterface import GetGCNConfig, AddGCN, UPSERTSTALE, Retry,\
+    IsLocked
+  from gcn_notice import ParseNotice
+  from gcn_events import gcnalertsock, Notify
+  # Home directory
+  homedir = environ['HOME']
+  # stop if something looks wrong
+except:
+  print 'Failed to load modules'
+  _exit(-1)
+
+################################################################################
+# Environment Setup
+################################################################################
+# GCN database
+try:
+  gcndbfname = environ['GCNDB']
+except:
+  gcndbfname = '%s/gcns.db'%homedir
+try:
+  gcndbname = environ['GCNDBNAME']
+except:
+  gcndbname = "gcns"
+
+try:
+  gcnalerts = environ['GCNALERTS']
+except:
+  gcnalerts = None
+
+try:
+  gcningestlog = environ['GCNINGESTLOG']
+except:
+  gcningestlog = '%s/logs/gcn-ingestd.log'%homedir
+
+try:
+  gcningestlock = environ['GCNINGESTLOCK']
+except:
+  gcningestlock = '/tmp/gcn-ingestd.lock'
+
+try:
+  gcningestsock = environ['GCNINGESTSOCK']
+except:
+  gcningestsock = '%s/.gcn-ingest.sock'%homedir
+
+try:
+  gcnspool = environ['GCNSPOOL']
+except:
+  gcnspool = '%s/gcn-spool'%homedir
+
+# Maximum number of notices to add before committing
+try:
+  gcningestbatch = int(environ['GCNINGESTBATCH'])
+except:
+  gcningestbatch = 100
+
+# Seconds between checks of the spool directory
+try:
+  gcningestinter = float(environ['GCNINGESTINTER'])
+except:
+  gcningestinter = 1.
+
+################################################################################
+# Useful functions
+################################################################################
+def dircheck(dir):
+  '''
+    Checks if the given directory exists, if not it attempts to create it.
+  '''
+  try:
+    stat(dir)
+  except:
+    makedirs(dir)
+  try:
+    stat(dir)
+    return True
+  except:
+    return False
+
+def readall(conn):
+  '''
+    Reads from the connection until the client shuts down its side
+  '''
+  chunks = []
+  while True:
+    chunk = conn.recv(65536)
+    if not chunk:
+      break
+    chunks.append(chunk)
+  return ''.join(chunks)
+
+################################################################################
+# App to run
+################################################################################
+
+class App():
+  def __init__(self,log=devnull,sockname=None,spool=None,inter=1.,batch=100,
+               pidfile='/tmp/gcn-ingestd.lock'):
+    self.stdin_path = '/dev/null'
+    self.stdout_path = log
+    self.stderr_path = log
+    self.pidfile_path =  pidfile
+    self.pidfile_timeout = 5
+    self.umask = 0022
+    self.log = log
+    self.sockname = sockname
+    self.spool = spool
+    self.inter = inter
+    self.batch = batch
+    self.dbcfg = None
+    self.srv = None
+    # GCNs changed by the current batch
+    self.changed = []
+
+  def run(self):
+    logging.basicConfig(filename=self.log,\
+                        format='%(asctime)s %(levelname)s: %(message)s',\
+                        filemode='a', level=logging.DEBUG)
+    self.dbcfg = GetGCNConfig(gcndbfname,gcndbname,"writer")
+    if self.dbcfg == None:
+      logging.error('GCN DB failed to initialize.')
+      _exit(-1)
+    if self.spool != None:
+      for sdir in ['tmp','new','failed']:
+        if not dircheck('%s/%s'%(self.spool,sdir)):
+          logging.error('Cannot create spool: %s'%self.spool)
+          _exit(-1)
+    if self.sockname != None:
+      if path.exists(self.sockname):
+        unlink(self.sockname)
+      self.srv = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+      self.srv.bind(self.sockname)
+      self.srv.listen(self.batch)
+    logging.info('Ingesting into %s'%gcndbfname)
+    while True:
+      try:
+        self.Check()
+      except:
+        logging.error('Failed to ingest:\n%s'%traceback.format_exc())
+        # Whatever the batch left uncommitted is dropped, its spooled notices
+        # are still in the spool for the next check
+        try:
+          self.dbcfg.dbconn.rollback()
+        except:
+          logging.error('Failed to roll back:\n%s'%traceback.format_exc())
+        time.sleep(self.inter)
+
+  def Accept(self):
+    '''
+      Waits up to inter for clients and returns all those ready, up to batch
+    '''
+    conns = []
+    if self.srv == None:
+      time.sleep(self.inter)
+      return conns
+    wait = self.inter
+    while len(conns) < self.batch:
+      rdy = select([self.srv],[],[],wait)[0]
+      if len(rdy) == 0:
+        break
+      conn, addr = self.srv.accept()
+      conn.settimeout(5.)
+      conns.append(conn)
+      wait = 0
+    return conns
+
+  def Spooled(self):
+    '''
+      Returns the file names waiting in the spool, up to batch
+    '''
+    if self.spool == None:
+      return []
+    return sorted(listdir('%s/new'%self.spool))[:self.batch]
+
+  def Parse(self,indata):
+    '''
+      Parses the given email. Returns the new gcninfo and None, or None and
+      the reply sent to the client.
+    '''
+    newgcn, perr = ParseNotice(indata)
+    if newgcn == None:
+      logging.error(perr)
+      return None, 'ERR %s\n'%perr
+    return newgcn, None
+
+  def Add(self,newgcns):
+    '''
+      Adds the given GCNs and commits them together, a whole transaction for
+      Retry. Returns the reply sent to the client for each.
+    '''
+    self.changed = []
+    replies = []
+    for newgcn in newgcns:
+      try:
+        id, status = AddGCN(newgcn,self.dbcfg,commit=False)
+      except Exception, e:
+        if IsLocked(e):
+          raise
+        logging.error('Failed to add new GCN:\n%s'%traceback.format_exc())
+        replies.append('ERR failed to add\n')
+        continue
+      if status == 0:
+        logging.error('Failed to add new GCN:%s %s'%(newgcn.inst,newgcn.trigid))
+        replies.append('ERR failed to add\n')
+        continue
+      logging.info('GCN:%s %s'%(newgcn.inst,newgcn.trigid))
+      if status != UPSERTSTALE:
+        self.changed.append((id,newgcn.trigid,newgcn.trig_tjd))
+      replies.append('OK %i %i\n'%(id,status))
+    self.dbcfg.dbconn.commit()
+    return replies
+
+  def Read(self,fname):
+    '''
+      Returns the contents of the given file of the spool, or None if it
+      cannot be read
+    '''
+    try:
+      fin = open('%s/new/%s'%(self.spool,fname),'r')
+      try:
+        return fin.read()
+      finally:
+        fin.close()
+    except:
+      logging.error('Failed to read %s:\n%s'%(fname,traceback.format_exc()))
+      return None
+
+  def Check(self):
+    '''
+      Adds every notice currently waiting and commits them together
+    '''
+    conns = self.Accept()
+    fnames = self.Spooled()
+    if len(conns) == 0 and len(fnames) == 0:
+      return
+    # Client or spool file, new gcninfo and reply of every email
+    emails = []
+    for conn in conns:
+      try:
+        indata = readall(conn)
+      except:
+        logging.error('Failed to read from client:\n%s'%traceback.format_exc())
+        emails.append([conn,None,None,'ERR failed to read\n'])
+        continue
+      emails.append([conn,None] + list(self.Parse(indata)))
+    for fname in fnames:
+      indata = self.Read(fname)
+      if indata == None:
+        emails.append([None,fname,None,'ERR failed to read\n'])
+        continue
+      emails.append([None,fname] + list(self.Parse(indata)))
+    newgcns = [ email[2] for email in emails if email[2] != None ]
+    # Replies are only sent once the whole batch is on disk. If it cannot be
+    # the clients are told to try again later and the notices spooled are
+    # left in the spool.
+    try:
+      replies = Retry(self.dbcfg,self.Add,newgcns)
+    except:
+      logging.error('Failed to commit %i notices:\n%s'%\
+                    (len(newgcns),traceback.format_exc()))
+      self.dbcfg.dbconn.rollback()
+      self.changed = []
+      replies = [ 'TEMPFAIL\n' ]*len(newgcns)
+    replies.reverse()
+    for email in emails:
+      if email[2] != None:
+        email[3] = replies.pop()
+    nadded = 0
+    for conn, fname, newgcn, reply in emails:
+      if reply.startswith('OK'):
+        nadded += 1
+      if conn != None:
+        try:
+          conn.sendall(reply)
+          conn.close()
+        except:
+          logging.error('Failed to reply to client:\n%s'%\
+                        traceback.format_exc())
+      elif not reply.startswith('TEMPFAIL'):
+        try:
+          if reply.startswith('OK'):
+            unlink('%s/new/%s'%(self.spool,fname))
+          else:
+            rename('%s/new/%s'%(self.spool,fname),
+                   '%s/failed/%s'%(self.spool,fname))
+        except:
+          logging.error('Failed to clear %s from the spool:\n%s'%\
+                        (fname,traceback.format_exc()))
+    logging.debug('Committed %i of %i notices'%(nadded,len(emails)))
+    if len(self.changed) == 0 or gcnalerts == None:
+      return
+    # Hand the changes to gcn-alertd, or update the site here if it is not
+    # running
+    notified = [ Notify(gcnalertsock,id,trigid,trig_tjd) \
+                 for id,trigid,trig_tjd in self.changed ]
+    if False in notified:
+      logging.info('Updating Site')
+      try:
+        alrtout = check_output(['%s/site-alerter.py'%pathname],stderr=STDOUT)
+        logging.info(alrtout)
+      except:
+        logging.error('site-alerter failed:\n%s'%traceback.format_exc())
+
+
+# Start daemon
+if __name__ == "__main__":
+  app = App(log=gcningestlog,sockname=gcningestsock,spool=gcnspool,
+            inter=gcningestinter,batch=gcningestbatch,pidfile=gcningestlock)
+  daemon_runner = runner.DaemonRunner(app)
+  daemon_runner.daemon_context.files_preserve=[gcningestlog]
+  daemon_runner.do_action();
@@ -20,15 +20,10 @@ except:
   print 'Failed to load base modules'
   sys.exit(-1)
 try:
-  try:
-    import xml.etree.ElementTree as ET
-  except:
-    try:
-      import elementtree.ElementTree as ET
-    except:
-      print 'Failed to load ElementTree'
-      _exit(-1)
-  from gcn_dbinterface import GetGCNConfig, AddGCN, gcninfo
+  from gcn_dbinterface import GetGCNConfig, AddGCN, UPSERTSTALE, Retry,\
+    lockstats, OperationalError
+  from gcn_notice import ParseNotice
+  from gcn_events import gcnalertsock, Notify
   # Home directory
   homedir = environ['HOME']
   # stop if something looks wrong
@@ -36,26 +31,6 @@ except:
   print 'Failed to load modules'
   _exit(-1)
 
-##############################################################################
-# Generic Settings
-##############################################################################
-# link to Swift gcn page
-swiftgcnlink="http://j.mp/swiftgcns"
-# link to Fermi gcn page
-fermigcnlink="http://j.mp/fermigcns"
-# link to Agile gcn page
-agilegcnlink="http://j.mp/agilegcns"
-# link to Integral gcn page
-integralgcnlink="http://j.mp/integralgcns"
-# link to Maxi gcn page
-maxigcnlink="http://j.mp/maxigcns"
-# link to KONUS gcn page
-konusgcnlink = "http://j.mp/konusgcns"
-# link to ICN gcn page
-icngcnlink="http://j.mp/icngcns"
-# link format
-linkfmt = "http://gcn.gsfc.nasa.gov/other/%s.%s"
-
 ################################################################################
 # Useful functions
 ################################################################################
@@ -89,96 +64,6 @@ def dircheck(dir):
     return False
 
 
-def GetParam(params,name,rattrib='value'):
-  '''
-    Returns an attribute value or None (if not found) from a list of 'Param's given.
-  '''
-  for param in params:
-    try:
-      attribs = param.attrib
-      if attribs['name'] == name:
-        return attribs[rattrib]
-    except:
-      continue
-  return None
-
-def GetGroup(groups,name):
-  '''
-    Returns 'Param's of group or None (if not found) from a list of 'Group's given.
-  '''
-  for groups in groups:
-    try:
-      attribs = groups.attrib
-      if attribs['name'] == name:
-        return groups.findall('Param')
-    except:
-      continue
-  return None
-
-def GetBurstTime(wparams):
-  btinfo = {'TJD':0 , 'SOD' : 0.0}
-  try:
-    btinfo['TJD'] = int(GetParam(wparams,'Burst_TJD'))
-    btinfo['SOD'] = float(GetParam(wparams,'Burst_SOD'))
-  except:
-    try:
-      btinfo['TJD'] = int(GetParam(wparams,'Event_TJD'))
-      btinfo['SOD'] = float(GetParam(wparams,'Event_SOD'))
-    except:
-      return None
-  return btinfo
-
-def ParseWhereWhen(wherewhen):
-  obsdatloc = wherewhen.find('ObsDataLocation')
-  if obsdatloc == None:
-    return None
-  obsloc = obsdatloc.find('ObservationLocation')
-  if obsloc == None:
-    return None
-  astrocoords = obsloc.find('AstroCoords')
-  if astrocoords == None:
-    return None
-  oinfo = {'coord_system_id':None,'time' : None,\
-           'RA': None, 'Dec': None, 'error': None, 'unit': None }
-  try:
-    oinfo['coord_system_id'] = astrocoords.attrib['coord_system_id']
-    oinfo['time'] = astrocoords.find('Time').find('TimeInstant').find('ISOTime').text.strip()
-    posobj = astrocoords.find('Position2D')
-    oinfo['unit'] = posobj.attrib['unit']
-    posarr = posobj.find('Value2')
-    name1 = posobj.find('Name1').text.strip()
-    name2 = posobj.find('Name2').text.strip()
-    if name1 == 'RA':
-      oinfo['RA'] = posarr.find('C1').text.strip()
-    elif name2 == 'RA':
-      oinfo['RA'] = posarr.find('C2').text.strip()
-    if name1 == 'Dec':
-      oinfo['Dec'] = posarr.find('C1').text.strip()
-    elif name2 == 'Dec':
-      oinfo['Dec'] = posarr.find('C2').text.strip()
-    if oinfo['RA'] == None or oinfo['Dec'] == None:
-      return None
-    oinfo['error'] = posobj.find('Error2Radius').text.strip()
-    return oinfo
-  except:
-    return None
-  return None
-
-def IsNotGRB(groups):
-  # Fermi
-  gparams = GetGroup(groups,'Trigger_ID')
-  if gparams != None:
-    return GetParam(gparams,'Def_NOT_a_GRB')
-  # Swift
-  gparams = GetGroup(groups,'Solution_Status')
-  if gparams != None:
-    return GetParam(gparams,'Def_NOT_a_GRB')
-  # INTEGRAL
-  gparams = GetGroup(groups,'Test_mpos')
-  if gparams != None:
-    return GetParam(gparams,'Def_NOT_a_GRB')
-  return "unknown"
-
 if __name__ == "__main__":
   ################################################################################
   # Generic Settings
@@ -218,9 +103,11 @@ if __name__ == "__main__":
   # Get GCN Database
   ################################################################################
   try:
-    dbcfg = GetGCNConfig(gcndbfname,gcndbname)
+    dbcfg = GetGCNConfig(gcndbfname,gcndbname,"writer")
   except:
     logging.error('Could not read %s'%gcndbname)
+    if lockstats["failures"] > 0:
+      easy_exit(75,None)
     easy_exit(-2,None)
   if dbcfg == None:
     logging.info('GCN DB failed to initialize.')
@@ -230,104 +117,48 @@ if __name__ == "__main__":
   ################################################################################
   # Read in data from standard input
   indata = sys.stdin.read()
-  xmlstart = indata.find('<?xml')
-  # Parse the input
-  try:
-    xroot = ET.fromstring(indata[xmlstart:])
-  except:
-    logging.error('Malformed XML (no root):\n%s'%traceback.format_exc())
-    easy_exit(-2,[dbcfg])
-
-
-  what = xroot.find('What')
-  wparams = what.findall('Param')
-  wgroups = what.findall('Group')
-  wherewhen = xroot.find('WhereWhen')
-  who = xroot.find('Who')
-
-  if what == None:
-    logging.error('Malformed XML (no What)')
-    easy_exit(-2,[dbcfg])
-  if wparams == None:
-    logging.error('Malformed XML (no What Params)')
-    easy_exit(-2,[dbcfg])
-  if wgroups == None:
-    logging.error('Malformed XML (no What Groups')
+  newgcn, perr = ParseNotice(indata)
+  if newgcn == None:
+    logging.error(perr)
     easy_exit(-2,[dbcfg])
-  if wherewhen == None:
-    logging.error('Malformed XML (no WhereWhen)')
-    easy_exit(-2,[dbcfg])
-  if who == None:
-    logging.error('Malformed XML (no Who)')
-    easy_exit(-2,[dbcfg])
-
-  newgcn = gcninfo()
 
-  newgcn.trigid = GetParam(wparams,'TrigID')
-  btinfo = GetBurstTime(wparams)
+  # Set if the GCN could not be added for now
+  tempfail = False
   try:
-    newgcn.trig_tjd = btinfo['TJD']
-    newgcn.trig_sod = btinfo['SOD']
+    id, status = Retry(dbcfg,AddGCN,newgcn,dbcfg)
+  except OperationalError:
+    # The DB could not be written for now (locked, full, I/O error)
+    logging.error('Failed to add new GCN:\n%s'%traceback.format_exc())
+    dbcfg.dbconn.rollback()
+    id, status = -1, 0
+    tempfail = True
   except:
-    logging.error('Malformed XML (odd Burst Time)')
-    easy_exit(-2,[dbcfg])
-
-  try:
-    tinfo = ParseWhereWhen(wherewhen)
-  except:
-    logging.error('Malformed XML (odd WhereWhen)')
-    easy_exit(-2,[dbcfg])
-  try:
-    newgcn.isnotgrb = IsNotGRB(wgroups)
-  except:
-    logging.error('Malformed XML (odd GRB status)')
-    easy_exit(-2,[dbcfg])
-  try:
-    newgcn.posunit = tinfo['unit']
-    newgcn.ra = tinfo['RA']
-    newgcn.dec = tinfo['Dec']
-    newgcn.error = tinfo['error']
-    newgcn.inten = GetParam(wparams,'Burst_Inten')
-    newgcn.intenunit = GetParam(wparams,'Burst_Inten','unit')
-    newgcn.mesgtype = what.find('Description').text
-    newgcn.updated_date = who.find('Date').text
-  except:
-    logging.error('Malformed XML')
-    easy_exit(-2,[dbcfg])
-  # derived
-  lcmesgtype = newgcn.mesgtype.lower()
-  if lcmesgtype.find('fermi') >= 0:
-    newgcn.inst = "Fermi"
-    newgcn.link = linkfmt%(newgcn.trigid,'fermi')
-  elif lcmesgtype.find('swift') >= 0:
-    newgcn.inst = "Swift"
-    newgcn.link = linkfmt%(newgcn.trigid,'swift')
-  elif lcmesgtype.find('integral') >= 0:
-    newgcn.inst = "Integral"
-    newgcn.link = linkfmt%(newgcn.trigid,'integral')
-  elif lcmesgtype.find('maxi') >= 0:
-    newgcn.inst = "MAXI"
-    newgcn.link = linkfmt%(newgcn.trigid,'maxi')
-  elif lcmesgtype.find('konus') >= 0:
-    newgcn.inst = "KONUS"
-    newgcn.link = konusgcnlink
-  elif lcmesgtype.find('ipn') >= 0:
-    newgcn.inst = "IPN"
-    newgcn.link = ipngcnlink
-
-
-
-  id, status = AddGCN(newgcn,dbcfg)
+    # The GCN cannot be added as it is (constraint, bad value)
+    logging.error('Failed to add new GCN:\n%s'%traceback.format_exc())
+    dbcfg.dbconn.rollback()
+    id, status = -1, 0
+  if lockstats["retries"] > 0 or lockstats["failures"] > 0:
+    logging.warning('GCN DB locked: %i retries in %.1f s, %i failures'\
+                    %(lockstats["retries"],lockstats["waited"],
+                      lockstats["failures"]))
+  if tempfail:
+    # Ask procmail to deliver the notice again later (EX_TEMPFAIL)
+    easy_exit(75,[dbcfg])
   # Close DB connections
   dbcfg.curs.close()
   dbcfg.dbconn.commit()
   if status == 0:
     logging.error('Failed to add new GCN:%s %s'%(newgcn.inst,newgcn.trigid))
+    easy_exit(-2,None)
+  elif status == UPSERTSTALE:
+    logging.info('GCN:%s %s not newer'%(newgcn.inst,newgcn.trigid))
     gcnalerts = None
   else:
     logging.info('GCN:%s %s'%(newgcn.inst,newgcn.trigid))
 
-  if gcnalerts != None:
+  # Hand the change to gcn-alertd, or update the site here if it is not running
+  if gcnalerts != None and \
+    not Notify(gcnalertsock,id,newgcn.trigid,newgcn.trig_tjd):
     logging.info('Updating Site')
     alrtout = check_output(['%s/site-alerter.py'%pathname],stderr=STDOUT)
     logging.info(alrtout)
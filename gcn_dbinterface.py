@@ -7,7 +7,8 @@
 #  Copyright 2011 Brian Baughman. All rights reserved.
 ################################################################################
 try:
-  import sys, re, datetime
+  import sys, re, datetime, json
+  from math import radians, degrees, sin, cos, asin, floor
   from sql_interface import *
   from os import environ, _exit
 except:
@@ -18,6 +19,8 @@ except:
 # Class used for storing GCNs with default values.
 ################################################################################
 class gcninfo(baseentry):
+  # Numbers, NULL if missing
+  __dbtypes__ = { "ra":float, "dec":float, "error":float, "inten":float }
   def __init__(self):
     self.id = "null"
     # Read directly
@@ -27,10 +30,10 @@ class gcninfo(baseentry):
     self.updated_date = "unset"
     self.isnotgrb = "unset"
     self.posunit = "unset"
-    self.ra = "unset"
-    self.dec = "unset"
-    self.error = "unset"
-    self.inten = "unset"
+    self.ra = None
+    self.dec = None
+    self.error = None
+    self.inten = None
     self.intenunit = "unset"
     self.mesgtype = "unset"
     # Derived
@@ -39,6 +42,17 @@ class gcninfo(baseentry):
     self.setDBType()
 
 
+class replicainfo(baseentry):
+  '''
+    Last change of the source DB applied to a replica, kept in a single row
+    with id 1
+  '''
+  def __init__(self):
+    self.id = "null"
+    self.srvseq = 0
+    self.setDBType()
+
+
 ################################################################################
 # SQLITE CONFIGURATION
 ################################################################################
@@ -52,32 +66,87 @@ gcnupkeys = [ "isnotgrb",
              "inten", "intenunit",
              "mesgtype"]
 
-def GetGCNConfig(dbfname,dbname):
-  return GetConfig(dbfname,dbname,gcninfo,gcnupkeys,gcnchkkeys)
+# Indexes, the first covers the most recent GCNs query of site-alerter
+gcnidxkeys = [ ["trig_tjd","trig_sod","trigid","updated_date"] ]
 
-def UpdateGCN(newEntry,id,cfg):
-  ustr = "UPDATE %s SET updated_date='%s' "%(cfg.dbname,newEntry.updated_date)
-  for cattr in gcnupkeys:
-    ustr += ', %s=\'%s\''%(cattr,newEntry.__getattribute__(cattr))
-  ustr += ' WHERE id=%i'%id
-  cfg.curs.execute(ustr)
-  cfg.dbconn.commit()
+# Columns, other than id, in the order used for rows given to AddGCNs
+gcnfields = GetDBKeys(gcninfo().__dbstruct__)
+
+# Sky index: level k splits the sky into declination bands skyband/2**k
+# degrees high, each split in RA into cells about as wide. A GCN is indexed in
+# the cell of its position at the finest level whose cells are at least twice
+# its error. Level 0 holds the GCNs with errors too large for level 1.
+skylevels = 9
+skyband = 90.
+# Cells are numbered level<<40 | band<<20 | RA cell, so those of a band are
+# consecutive
+skylevelbits = 40
+skybandbits = 20
+
+def GetGCNConfig(dbfname,dbname,profile="default"):
+  # Only replace a GCN with a more recently updated one
+  upcond = "replace(excluded.updated_date,'T',' ') > "
+  upcond += "replace(%s.updated_date,'T',' ')"%dbname
+  cfg = GetConfig(dbfname,dbname,gcninfo,["updated_date"]+gcnupkeys,
+                  gcnchkkeys,upcond,gcnidxkeys,changelog=True,profile=profile)
+  if cfg == None:
+    return None
+  try:
+    Retry(cfg,SkySetup,cfg)
+  except:
+    cfg.dbconn.close()
+    return None
+  return cfg
+
+def GCNRow(newEntry):
+  '''
+    Returns the given gcninfo as a tuple ordered as gcnfields
+  '''
+  return tuple([newEntry.__getattribute__(cattr) for cattr in gcnfields])
+
+def UpdateGCN(newEntry,id,cfg,commit=True):
+  carr = [ newEntry.__getattribute__(cattr) for cattr in cfg.upkeys ]
+  cfg.curs.execute(cfg.upstr,carr+[id])
+  if commit:
+    cfg.dbconn.commit()
   return 0
 
-def AddGCN(newEntry,cfg):
-  carr = [ newEntry.__getattribute__(cattr) for cattr in cfg.chkstruct.keys()]
-  ckstr = cfg.ckstr%tuple(carr)
-  cfg.curs.execute(ckstr)
+def AddGCN(newEntry,cfg,commit=True):
+  '''
+    Adds or updates the given gcninfo, and its place in the sky index. If
+    commit is False the caller is responsible for committing, which allows
+    several GCNs to share a commit.
+    Returns the id and UPSERTNEW for new GCNs, or minus the id and
+    UPSERTUPDATED or UPSERTSTALE (if it was not newer) for existing ones.
+    Returns -1, 0 on failure.
+  '''
+  id, status = WriteGCN(newEntry,cfg)
+  if status == UPSERTNEW or status == UPSERTUPDATED:
+    SkyAdd(cfg,[(abs(id),newEntry.ra,newEntry.dec,newEntry.error)])
+  if commit:
+    cfg.dbconn.commit()
+  return id, status
+
+def WriteGCN(newEntry,cfg):
+  '''
+    Does the work of AddGCN but for the sky index, without committing
+  '''
+  if cfg.upsertstr != None:
+    carr = [ newEntry.__getattribute__(cattr) for cattr in cfg.instkeys ]
+    id, status = Upsert(cfg,carr)
+    if status == UPSERTNEW:
+      return id, status
+    return -1*id, status
+  # Without the unique index check for the GCN first
+  carr = [ newEntry.__getattribute__(cattr) for cattr in cfg.ckkeys ]
+  cfg.curs.execute(cfg.ckstr,carr)
   mtchs = cfg.curs.fetchall()
   if len(mtchs) == 0:
-    carr = [newEntry.__getattribute__(cattr) for cattr in cfg.dbstruct.keys() ]
-    cintstr = cfg.inststr%tuple(carr)
-    cfg.curs.execute(cintstr)
-    cfg.dbconn.commit()
-    cfg.curs.execute("select last_insert_rowid()")
-    retval = cfg.curs.fetchall()
-    njid = retval[0][0]
-    return njid, 1
+    carr = [ newEntry.__getattribute__(cattr) for cattr in cfg.instkeys ]
+    cfg.curs.execute(cfg.inststr,carr)
+    njid = cfg.curs.lastrowid
+    cfg.lastrowid = njid
+    return njid, UPSERTNEW
   elif len(mtchs) == 1:
     # update entry if newer than already logged
     oldEntry = MakeEntry(mtchs[0],gcninfo,cfg.dbstruct)
@@ -87,6 +156,371 @@ def AddGCN(newEntry,cfg):
     nTo = datetime.datetime.strptime(nT,'%Y-%m-%d %H:%M:%S')
     dT = (nTo - oTo)
     if dT > datetime.timedelta(seconds = 0):
-      UpdateGCN(newEntry,mtchs[0][cfg.dbstruct['id']['index']],cfg)
-    return -1*mtchs[-1][cfg.dbstruct['id']['index']], -1
+      UpdateGCN(newEntry,mtchs[0][cfg.dbstruct['id']['index']],cfg,False)
+      return -1*mtchs[-1][cfg.dbstruct['id']['index']], UPSERTUPDATED
+    return -1*mtchs[-1][cfg.dbstruct['id']['index']], UPSERTSTALE
   return -1, 0
+
+
+def LoadGCNs(cfg,cond=None,args=()):
+  '''
+    Returns the GCNs, all of them or those meeting the SQL condition cond
+    with placeholders for args, ordered by id, as read only rows with the
+    columns as attributes (see RowType)
+  '''
+  selstr = "SELECT * FROM %s"%cfg.dbname
+  if cond != None:
+    selstr += " WHERE %s"%cond
+  curs = RowCursor(cfg,gcninfo)
+  try:
+    curs.execute("%s ORDER BY id;"%selstr,args)
+    return curs.fetchall()
+  finally:
+    curs.close()
+
+def GetGCNKeys(cfg):
+  '''
+    Returns a dictionary of the updated_date of every GCN in the DB keyed on
+    the gcnchkkeys values
+  '''
+  cfg.curs.execute("SELECT %s,updated_date FROM %s;"%(','.join(gcnchkkeys),
+                                                       cfg.dbname))
+  nkeys = len(gcnchkkeys)
+  known = {}
+  for row in cfg.curs:
+    known[tuple(row[:nkeys])] = row[nkeys]
+  return known
+
+def AddGCNs(rows,cfg,known=None,commit=True,rejects=None):
+  '''
+    Adds or updates many GCNs at once. Rows are tuples ordered as gcnfields.
+    Duplicates are resolved in memory against known (see GetGCNKeys), which is
+    updated in place, so only the most recent version of each GCN is written.
+    GCNs are written in the order they first appear in rows.
+    A row the DB refuses aborts the whole batch, which is then rolled back,
+    so the caller must not have uncommitted changes, and written again row by
+    row. The rows refused are skipped and, if rejects is a list, appended to
+    it with the error.
+    Returns the number of GCNs inserted and updated.
+  '''
+  if known == None:
+    known = GetGCNKeys(cfg)
+  kindx = [ gcnfields.index(cattr) for cattr in gcnchkkeys ]
+  dindx = gcnfields.index("updated_date")
+  latest = {}
+  order = []
+  for row in rows:
+    key = tuple([row[i] for i in kindx])
+    nT = str(row[dindx]).replace('T',' ')
+    if key in latest and nT <= str(latest[key][dindx]).replace('T',' '):
+      continue
+    if key in known and nT <= str(known[key]).replace('T',' '):
+      continue
+    if key not in latest:
+      order.append(key)
+    latest[key] = row
+  lastrowid = cfg.lastrowid
+  try:
+    ninst, nupd = WriteGCNs([ latest[key] for key in order ],cfg,known)
+  except DatabaseError, e:
+    if IsLocked(e):
+      raise
+    cfg.dbconn.rollback()
+    cfg.lastrowid = lastrowid
+    ninst = 0
+    nupd = 0
+    for key in order:
+      try:
+        ni, nu = WriteGCNs([latest[key]],cfg,known)
+      except DatabaseError, e:
+        if IsLocked(e):
+          raise
+        if rejects != None:
+          rejects.append((latest[key],e))
+        continue
+      ninst += ni
+      nupd += nu
+  if commit:
+    cfg.dbconn.commit()
+  return ninst, nupd
+
+def WriteGCNs(rows,cfg,known):
+  '''
+    Does the work of AddGCNs for rows already resolved against known, without
+    committing. known is only updated once all of them are written.
+  '''
+  inserts = []
+  updates = []
+  iindx = [ gcnfields.index(cattr) for cattr in cfg.instkeys ]
+  uindx = [ gcnfields.index(cattr) for cattr in cfg.upkeys + cfg.ckkeys ]
+  kindx = [ gcnfields.index(cattr) for cattr in gcnchkkeys ]
+  cindx = [ gcnfields.index(cattr) for cattr in cfg.ckkeys ]
+  for row in rows:
+    if tuple([row[i] for i in kindx]) in known:
+      updates.append(tuple([row[i] for i in uindx]))
+    else:
+      inserts.append(tuple([row[i] for i in iindx]))
+  if len(inserts) > 0:
+    InsertMany(cfg,inserts)
+  if len(updates) > 0:
+    UpdateMany(cfg,updates,bykey=True)
+  # Ids are only known once written
+  pindx = [ cfg.dbstruct[cattr]['index'] for cattr in ["id","ra","dec","error"] ]
+  skyrows = []
+  ckeys = [ tuple([row[i] for i in cindx]) for row in rows ]
+  for mtchs in CheckMany(cfg,ckeys):
+    for row in mtchs:
+      skyrows.append(tuple([row[i] for i in pindx]))
+  SkyAdd(cfg,skyrows)
+  dindx = gcnfields.index("updated_date")
+  for row in rows:
+    known[tuple([row[i] for i in kindx])] = row[dindx]
+  return len(inserts), len(updates)
+
+def ExportGCNs(cfg,afterseq,fout):
+  '''
+    Writes the GCNs changed after the change afterseq, or all GCNs if it is 0
+    or unknown to this DB, to fout as lines of JSON: the last change and the
+    columns, one line per GCN, ordered as the columns, and the number of GCNs
+    written. Returns the number of GCNs written.
+  '''
+  fields = ["id"] + gcnfields
+  selstr = "SELECT %s FROM %s"%(','.join(fields),cfg.dbname)
+  # Read the last change and the GCNs from one snapshot
+  cfg.curs.execute("BEGIN;")
+  try:
+    lastseq = LastChange(cfg)
+    if afterseq > 0 and afterseq <= lastseq:
+      selstr += " WHERE id IN (SELECT id FROM %s"%cfg.chgname
+      selstr += " WHERE seq > ? AND seq <= ?)"
+      cfg.curs.execute("%s ORDER BY id;"%selstr,(afterseq,lastseq))
+    else:
+      cfg.curs.execute("%s ORDER BY id;"%selstr)
+    fout.write('%s\n'%json.dumps({"seq":lastseq,"fields":fields}))
+    nrows = 0
+    for row in cfg.curs:
+      fout.write('%s\n'%json.dumps(row))
+      nrows += 1
+  finally:
+    cfg.dbconn.rollback()
+  fout.write('%s\n'%json.dumps({"count":nrows}))
+  return nrows
+
+def GetReplicaSeq(cfg):
+  '''
+    Returns the last change of the source DB applied to this replica
+  '''
+  rplname = '%s_replica'%cfg.dbname
+  if CheckDB(cfg.curs,rplname,replicainfo().__dbstruct__) == None:
+    return None
+  cfg.curs.execute("SELECT srvseq FROM %s WHERE id=1;"%rplname)
+  row = cfg.curs.fetchone()
+  if row == None:
+    return 0
+  return row[0]
+
+def ImportGCNs(cfg,fin,batch=1000):
+  '''
+    Applies GCNs written by ExportGCNs to this replica, keeping their ids,
+    and records the last change applied. Nothing is committed unless the
+    whole export was read. Returns the number of GCNs and the last change.
+  '''
+  rplname = '%s_replica'%cfg.dbname
+  try:
+    head = json.loads(fin.readline())
+    lastseq = head["seq"]
+    fields = head["fields"]
+    instr = "INSERT OR REPLACE INTO %s (%s)"%(cfg.dbname,','.join(fields))
+    instr += " VALUES (%s);"%(','.join(['?']*len(fields)))
+    pindx = [ fields.index(cattr) for cattr in ["id","ra","dec","error"] ]
+    rows = []
+    nrows = 0
+    count = None
+    for line in fin:
+      row = json.loads(line)
+      if isinstance(row,dict):
+        count = row["count"]
+        break
+      rows.append(row)
+      if len(rows) >= batch:
+        cfg.curs.executemany(instr,rows)
+        SkyAdd(cfg,[ [row[i] for i in pindx] for row in rows ])
+        nrows += len(rows)
+        rows = []
+    cfg.curs.executemany(instr,rows)
+    SkyAdd(cfg,[ [row[i] for i in pindx] for row in rows ])
+    nrows += len(rows)
+    if count != nrows:
+      raise ValueError('Export incomplete, %i of %s GCNs'%(nrows,count))
+    cfg.curs.execute("INSERT OR REPLACE INTO %s (id,srvseq) VALUES (1,?);"\
+                     %rplname,(lastseq,))
+    cfg.dbconn.commit()
+  except:
+    cfg.dbconn.rollback()
+    raise
+  return nrows, lastseq
+
+
+################################################################################
+# Sky index
+################################################################################
+def SkyLevel(error):
+  '''
+    Returns the level at which a GCN with the given error, in degrees, is
+    indexed
+  '''
+  if error == None or error <= 0:
+    return skylevels - 1
+  level = 0
+  while level < skylevels - 1 and skyband/2**(level+1) >= 2.*error:
+    level += 1
+  return level
+
+def SkyBand(level,band):
+  '''
+    Returns the number of RA cells in the given band
+  '''
+  height = skyband/2**level
+  declo = -90. + band*height
+  dechi = declo + height
+  if declo < 0. and dechi > 0.:
+    dec = 0.
+  else:
+    dec = min(abs(declo),abs(dechi))
+  return max(1,int(360.*cos(radians(dec))/height))
+
+def SkyCell(ra,dec,level):
+  '''
+    Returns the cell holding the given position, in degrees, at level
+  '''
+  height = skyband/2**level
+  nbands = int(round(180./height))
+  band = min(int((dec + 90.)/height),nbands - 1)
+  ncells = SkyBand(level,band)
+  rac = int(floor((ra%360.)/360.*ncells))%ncells
+  return (level<<skylevelbits) | (band<<skybandbits) | rac
+
+def SkyRanges(ra,dec,radius,level):
+  '''
+    Returns the first and last cells of the runs of cells, at level, which
+    together cover the circle of radius around ra, dec, all in degrees
+  '''
+  height = skyband/2**level
+  nbands = int(round(180./height))
+  declo = max(dec - radius,-90.)
+  dechi = min(dec + radius,90.)
+  blo = min(int((declo + 90.)/height),nbands - 1)
+  bhi = min(int((dechi + 90.)/height),nbands - 1)
+  # Half width in RA of the circle, all RA if it holds a pole
+  if dechi >= 90. or declo <= -90.:
+    dra = 180.
+  else:
+    dra = degrees(asin(min(sin(radians(radius))/cos(radians(dec)),1.)))
+  ranges = []
+  for band in xrange(blo,bhi + 1):
+    first = (level<<skylevelbits) | (band<<skybandbits)
+    ncells = SkyBand(level,band)
+    clo = int(floor((ra - dra)/360.*ncells))
+    chi = int(floor((ra + dra)/360.*ncells))
+    if dra >= 180. or chi - clo + 1 >= ncells:
+      ranges.append((first,first + ncells - 1))
+    elif clo%ncells <= chi%ncells:
+      ranges.append((first + clo%ncells,first + chi%ncells))
+    else:
+      # Across RA 0
+      ranges.append((first + clo%ncells,first + ncells - 1))
+      ranges.append((first,first + chi%ncells))
+  return ranges
+
+def SkySetup(cfg):
+  '''
+    Creates the sky index of the GCN DB, filling it from the GCNs already
+    there, if it does not exist and sets cfg.skyname
+  '''
+  skyname = '%s_sky'%cfg.dbname
+  # Without a rowid so writing the index leaves last_insert_rowid(), used by
+  # Upsert, alone. ra, dec and error are kept so searches need not read the
+  # GCNs.
+  skystr = "CREATE TABLE IF NOT EXISTS %s (cell INTEGER NOT NULL,"%skyname
+  skystr += " id INTEGER NOT NULL, ra REAL NOT NULL, dec REAL NOT NULL,"
+  skystr += " error REAL, PRIMARY KEY (cell,id)) WITHOUT ROWID;"
+  cfg.curs.execute(skystr)
+  cfg.curs.execute("CREATE UNIQUE INDEX IF NOT EXISTS %s_id ON %s (id);"\
+                   %(skyname,skyname))
+  cfg.skyname = skyname
+  # Fill an empty index from the GCNs already there
+  cfg.curs.execute("SELECT count(*) FROM (SELECT id FROM %s LIMIT 1);"%skyname)
+  if cfg.curs.fetchone()[0] > 0:
+    return
+  cfg.curs.execute("SELECT id, ra, dec, error FROM %s WHERE ra NOT NULL;"\
+                   %cfg.dbname)
+  SkyAdd(cfg,cfg.curs.fetchall())
+  cfg.dbconn.commit()
+
+def SkyAdd(cfg,rows):
+  '''
+    Places GCNs, given as (id, ra, dec, error), in the sky index, without
+    committing. GCNs without a position are left out.
+  '''
+  if cfg.skyname == None or len(rows) == 0:
+    return
+  cfg.curs.executemany("DELETE FROM %s WHERE id=?;"%cfg.skyname,
+                       [ (row[0],) for row in rows ])
+  cells = []
+  for id, ra, dec, error in rows:
+    if ra == None or dec == None:
+      continue
+    cells.append((SkyCell(ra,dec,SkyLevel(error)),id,ra,dec,error))
+  cfg.curs.executemany("INSERT INTO %s (cell,id,ra,dec,error) VALUES (?,?,?,?,?);"\
+                       %cfg.skyname,cells)
+
+def ConeSearch(cfg,ra,dec,radius,overlap=True):
+  '''
+    Returns the ids of the GCNs within radius of ra, dec, or with overlap set
+    those whose error circle comes within radius, and their distances, nearest
+    first. All in degrees. The sky index gives the GCNs in the cells around
+    the position, whose distances are then worked out together.
+  '''
+  # Imported here so adding GCNs does not need numpy
+  import numpy
+  ranges = []
+  for level in xrange(skylevels):
+    if overlap and level == 0:
+      # Errors at level 0 are unbounded
+      ranges.append((0,(1<<skylevelbits) - 1))
+    elif overlap:
+      ranges += SkyRanges(ra,dec,radius + skyband/2**(level+1),level)
+    else:
+      ranges += SkyRanges(ra,dec,radius,level)
+  rows = []
+  # Within the limit on the number of placeholders
+  for i in xrange(0,len(ranges),400):
+    cranges = ranges[i:i+400]
+    selstr = "WITH r(lo,hi) AS (VALUES %s)"%(','.join(['(?,?)']*len(cranges)))
+    selstr += " SELECT s.id, s.ra, s.dec, s.error FROM r JOIN %s AS s"%cfg.skyname
+    selstr += " ON s.cell BETWEEN r.lo AND r.hi"
+    # Cells can be much larger than the circle, the difference in dec is a
+    # lower bound on the distance
+    if overlap:
+      selstr += " WHERE abs(s.dec - ?) <= ? + ifnull(s.error,0.);"
+    else:
+      selstr += " WHERE abs(s.dec - ?) <= ?;"
+    cfg.curs.execute(selstr,[ cell for crange in cranges for cell in crange ]+
+                     [dec,radius])
+    rows += cfg.curs.fetchall()
+  if len(rows) == 0:
+    return numpy.zeros(0,dtype=int), numpy.zeros(0)
+  cands = numpy.array(rows,dtype=float)
+  cra = numpy.radians(cands[:,1])
+  cdec = numpy.radians(cands[:,2])
+  dec0 = radians(dec)
+  # Haversine
+  hav = numpy.sin((cdec - dec0)/2.)**2 + \
+    numpy.cos(cdec)*cos(dec0)*numpy.sin((cra - radians(ra))/2.)**2
+  dist = numpy.degrees(2.*numpy.arcsin(numpy.sqrt(numpy.minimum(hav,1.))))
+  lim = numpy.zeros(len(rows)) + radius
+  if overlap:
+    lim += numpy.nan_to_num(cands[:,3])
+  mtch = numpy.where(dist <= lim)[0]
+  mtch = mtch[numpy.argsort(dist[mtch])]
+  return cands[mtch,0].astype(int), dist[mtch]
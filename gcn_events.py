@@ -0,0 +1,75 @@
+#!/usr/bin/env python
+################################################################################
+#  gcn_events.py
+#  "GCN changed" events sent over a local Unix datagram socket from the
+#  processes adding GCNs to gcn-alertd, which runs site-alerter.
+################################################################################
+try:
+  import sys, socket, errno
+  from os import environ, path, unlink, _exit
+  from select import select
+  from time import time
+  # Home directory
+  homedir = environ['HOME']
+except:
+  print 'Failed to load base modules'
+  sys.exit(-1)
+
+try:
+  gcnalertsock = environ['GCNALERTSOCK']
+except:
+  gcnalertsock = '%s/.gcn-alert.sock'%homedir
+
+# Errors meaning gcn-alertd is listening with events waiting, any other means
+# the event was not delivered
+fullreader = [ errno.EAGAIN, errno.EWOULDBLOCK, errno.ENOBUFS ]
+
+def Notify(sockname,id,trigid,trig_tjd):
+  '''
+    Sends a GCN changed event without waiting. Returns False if it was not
+    delivered, e.g. gcn-alertd is not listening or sockname is not its
+    socket. A full socket means gcn-alertd has events waiting, so it will see
+    this change anyway, and counts as delivered.
+  '''
+  conn = socket.socket(socket.AF_UNIX,socket.SOCK_DGRAM)
+  conn.setblocking(0)
+  try:
+    conn.sendto('GCN %i %s %s'%(abs(id),trigid,trig_tjd),sockname)
+  except socket.error, e:
+    if e.errno not in fullreader:
+      return False
+  finally:
+    conn.close()
+  return True
+
+def Listen(sockname):
+  '''
+    Returns the socket on which events are received
+  '''
+  if path.exists(sockname):
+    unlink(sockname)
+  srv = socket.socket(socket.AF_UNIX,socket.SOCK_DGRAM)
+  srv.bind(sockname)
+  return srv
+
+def Events(srv,timeout,delay=0.):
+  '''
+    Waits up to timeout for an event, then gathers those arriving within
+    delay of it. Returns a list of (id, trigid, trig_tjd).
+  '''
+  events = []
+  wait = timeout
+  until = None
+  while True:
+    rdy = select([srv],[],[],wait)[0]
+    if len(rdy) == 0:
+      break
+    try:
+      fields = srv.recv(1024).split()
+      events.append((int(fields[1]),fields[2],fields[3]))
+    except (IndexError, ValueError):
+      pass
+    if until == None:
+      until = time() + delay
+    wait = max(until - time(),0.)
+  return events
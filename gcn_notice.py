@@ -0,0 +1,252 @@
+#!/usr/bin/env python
+################################################################################
+#  gcn_notice.py
+#  Parses XML notices sent via email by the GCN (http://gcn.gsfc.nasa.gov)
+#  into gcninfo entries. Shared by gcn-parser and gcn-ingestd.
+################################################################################
+try:
+  import sys, re
+  from os import _exit
+  try:
+    import xml.etree.cElementTree as ET
+  except:
+    try:
+      import xml.etree.ElementTree as ET
+    except:
+      try:
+        import elementtree.ElementTree as ET
+      except:
+        print 'Failed to load ElementTree'
+        _exit(-1)
+  from gcn_dbinterface import gcninfo, gcnfields, GCNRow, ConvertValue
+except:
+  print 'Failed to load modules'
+  _exit(-1)
+
+##############################################################################
+# Generic Settings
+##############################################################################
+# link to Swift gcn page
+swiftgcnlink="http://j.mp/swiftgcns"
+# link to Fermi gcn page
+fermigcnlink="http://j.mp/fermigcns"
+# link to Agile gcn page
+agilegcnlink="http://j.mp/agilegcns"
+# link to Integral gcn page
+integralgcnlink="http://j.mp/integralgcns"
+# link to Maxi gcn page
+maxigcnlink="http://j.mp/maxigcns"
+# link to KONUS gcn page
+konusgcnlink = "http://j.mp/konusgcns"
+# link to ICN gcn page
+icngcnlink="http://j.mp/icngcns"
+# link format
+linkfmt = "http://gcn.gsfc.nasa.gov/other/%s.%s"
+
+################################################################################
+# Notice schemas
+################################################################################
+# Params read directly into gcninfo: column, Param name, attribute
+gcnparams = [ ("trigid","TrigID","value"),
+              ("inten","Burst_Inten","value"),
+              ("intenunit","Burst_Inten","unit") ]
+# Params holding the trigger TJD and SOD, in order of preference
+gcntimes = [ ("Burst_TJD","Burst_SOD"),
+             ("Event_TJD","Event_SOD") ]
+# Groups searched for Def_NOT_a_GRB after those of the mission
+gcnnotgrb = [ "Trigger_ID", "Solution_Status", "Test_mpos" ]
+# Per mission settings keyed on the name found in the notice Description.
+# Either linktag (for linkfmt) or a fixed link is given.
+gcnmissions = {
+  "fermi"    : { "inst":"Fermi",    "linktag":"fermi",
+                 "notgrb":["Trigger_ID"] },
+  "swift"    : { "inst":"Swift",    "linktag":"swift",
+                 "notgrb":["Solution_Status"] },
+  "integral" : { "inst":"Integral", "linktag":"integral",
+                 "notgrb":["Test_mpos"] },
+  "maxi"     : { "inst":"MAXI",     "linktag":"maxi",
+                 "notgrb":[] },
+  "konus"    : { "inst":"KONUS",    "link":konusgcnlink,
+                 "notgrb":[] },
+  "ipn"      : { "inst":"IPN",      "link":icngcnlink,
+                 "notgrb":[] },
+}
+# Used when the Description names no known mission
+gcnunknown = { "inst":"unset", "link":"unset", "notgrb":[] }
+# Mission chosen when a Description names several
+gcnmissionorder = [ "fermi", "swift", "integral", "maxi", "konus", "ipn" ]
+for cmission in gcnmissions.values() + [gcnunknown]:
+  cmission.setdefault("params",gcnparams)
+  cmission.setdefault("times",gcntimes)
+  cmission["notgrb"] = cmission["notgrb"] + \
+    [ gname for gname in gcnnotgrb if gname not in cmission["notgrb"] ]
+missionre = re.compile('|'.join(gcnmissionorder))
+
+################################################################################
+# Useful functions
+################################################################################
+def IndexWhat(what):
+  '''
+    Returns dictionaries of the attributes of the 'Param's of What keyed on
+    name, and of the 'Param's of each 'Group' keyed on group name then name.
+    Where names repeat the first is kept.
+  '''
+  params = {}
+  groups = {}
+  for elem in what:
+    if elem.tag == 'Param':
+      params.setdefault(elem.get('name'),elem.attrib)
+    elif elem.tag == 'Group':
+      gparams = {}
+      for param in elem.findall('Param'):
+        gparams.setdefault(param.get('name'),param.attrib)
+      groups.setdefault(elem.get('name'),gparams)
+  return params, groups
+
+def GetMission(mesgtype):
+  '''
+    Returns the settings of the mission named in the notice Description
+  '''
+  found = missionre.findall(mesgtype.lower())
+  if len(found) == 0:
+    return gcnunknown
+  return gcnmissions[min(found,key=gcnmissionorder.index)]
+
+def GetBurstTime(params,times=gcntimes):
+  for tjdname, sodname in times:
+    try:
+      return {'TJD' : int(params[tjdname]['value']),
+              'SOD' : float(params[sodname]['value'])}
+    except:
+      continue
+  return None
+
+def ParseWhereWhen(wherewhen):
+  obsdatloc = wherewhen.find('ObsDataLocation')
+  if obsdatloc == None:
+    return None
+  obsloc = obsdatloc.find('ObservationLocation')
+  if obsloc == None:
+    return None
+  astrocoords = obsloc.find('AstroCoords')
+  if astrocoords == None:
+    return None
+  oinfo = {'coord_system_id':None,'time' : None,\
+           'RA': None, 'Dec': None, 'error': None, 'unit': None }
+  try:
+    oinfo['coord_system_id'] = astrocoords.attrib['coord_system_id']
+    oinfo['time'] = astrocoords.find('Time').find('TimeInstant').find('ISOTime').text.strip()
+    posobj = astrocoords.find('Position2D')
+    oinfo['unit'] = posobj.attrib['unit']
+    posarr = posobj.find('Value2')
+    name1 = posobj.find('Name1').text.strip()
+    name2 = posobj.find('Name2').text.strip()
+    if name1 == 'RA':
+      oinfo['RA'] = posarr.find('C1').text.strip()
+    elif name2 == 'RA':
+      oinfo['RA'] = posarr.find('C2').text.strip()
+    if name1 == 'Dec':
+      oinfo['Dec'] = posarr.find('C1').text.strip()
+    elif name2 == 'Dec':
+      oinfo['Dec'] = posarr.find('C2').text.strip()
+    if oinfo['RA'] == None or oinfo['Dec'] == None:
+      return None
+    oinfo['error'] = posobj.find('Error2Radius').text.strip()
+    return oinfo
+  except:
+    return None
+  return None
+
+def IsNotGRB(groups,names=gcnnotgrb):
+  for gname in names:
+    if gname in groups:
+      return groups[gname].get('Def_NOT_a_GRB',{}).get('value')
+  return "unknown"
+
+def ParseNotice(indata):
+  '''
+    Parses the raw contents of a GCN email (headers may be included) and
+    returns a tuple of the new gcninfo and None, or None and a message
+    describing why the notice could not be parsed.
+  '''
+  xmlstart = indata.find('<?xml')
+  # Parse the input
+  try:
+    xroot = ET.fromstring(indata[xmlstart:])
+  except:
+    return None, 'Malformed XML (no root)'
+
+  what = xroot.find('What')
+  if what == None:
+    return None, 'Malformed XML (no What)'
+  wparams, wgroups = IndexWhat(what)
+  wherewhen = xroot.find('WhereWhen')
+  who = xroot.find('Who')
+
+  if wherewhen == None:
+    return None, 'Malformed XML (no WhereWhen)'
+  if who == None:
+    return None, 'Malformed XML (no Who)'
+  try:
+    mesgtype = what.find('Description').text
+    mission = GetMission(mesgtype)
+  except:
+    return None, 'Malformed XML (no Description)'
+
+  newgcn = gcninfo()
+
+  for cattr, pname, rattrib in mission['params']:
+    newgcn.__setattr__(cattr,wparams.get(pname,{}).get(rattrib))
+  btinfo = GetBurstTime(wparams,mission['times'])
+  try:
+    newgcn.trig_tjd = btinfo['TJD']
+    newgcn.trig_sod = btinfo['SOD']
+  except:
+    return None, 'Malformed XML (odd Burst Time)'
+
+  try:
+    tinfo = ParseWhereWhen(wherewhen)
+  except:
+    return None, 'Malformed XML (odd WhereWhen)'
+  try:
+    newgcn.isnotgrb = IsNotGRB(wgroups,mission['notgrb'])
+  except:
+    return None, 'Malformed XML (odd GRB status)'
+  try:
+    newgcn.posunit = tinfo['unit']
+    newgcn.ra = tinfo['RA']
+    newgcn.dec = tinfo['Dec']
+    newgcn.error = tinfo['error']
+    newgcn.mesgtype = mesgtype
+    newgcn.updated_date = who.find('Date').text
+  except:
+    return None, 'Malformed XML'
+  # Other columns are NOT NULL, those missing from the notice keep the
+  # default of gcninfo
+  defgcn = None
+  for cattr in gcnfields:
+    if newgcn.__getattribute__(cattr) != None or cattr in gcninfo.__dbtypes__:
+      continue
+    if defgcn == None:
+      defgcn = gcninfo()
+    newgcn.__setattr__(cattr,defgcn.__getattribute__(cattr))
+  # Numeric columns, None if missing or not a number
+  for cattr, ctype in gcninfo.__dbtypes__.items():
+    newgcn.__setattr__(cattr,ConvertValue(newgcn.__getattribute__(cattr),ctype))
+  # derived
+  newgcn.inst = mission['inst']
+  if 'linktag' in mission:
+    newgcn.link = linkfmt%(newgcn.trigid,mission['linktag'])
+  else:
+    newgcn.link = mission['link']
+  return newgcn, None
+
+def NoticeRow(indata):
+  '''
+    As ParseNotice but returns the GCN as a plain tuple (see GCNRow), which is
+    cheap to pass between processes.
+  '''
+  newgcn, perr = ParseNotice(indata)
+  if newgcn == None:
+    return None, perr
+  return GCNRow(newgcn), None
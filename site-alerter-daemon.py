@@ -7,7 +7,7 @@
 #  Copyright 2013 Brian Baughman. All rights reserved.
 ################################################################################
 try:
-  import sys, re, time
+  import sys, re, time, logging, traceback, random
   from daemon import runner
   from os import environ, path, _exit, makedirs, stat, devnull, access, X_OK
   from subprocess import call, STDOUT, PIPE, Popen
@@ -38,6 +38,9 @@ try:
   from numpy import deg2rad, rad2deg, arange, asarray, array, pi, where, iterable
   import ephem
   from bitly import shorten
+  from gcn_dbinterface import GetGCNConfig, GetReplicaSeq, ImportGCNs
+  from site_alerter import SiteAlerter, ManifestRead, ManifestDone,\
+    manifestfname, filehash, gcnforecast
   
   # Home directory
   homedir = environ['HOME']
@@ -54,13 +57,6 @@ if call(['rsync','--version'],stdout=devnullfobj,stderr=devnullfobj):
 devnullfobj.close()
 
 
-if not path.isfile('%s/site-alerter.py'%pathname):
-  print 'Cannot file site-alerter.py!'
-  _exit(-1)
-
-if not access('%s/site-alerter.py'%pathname,X_OK):
-  print 'Cannot execute site-alerter.py!'
-  _exit(-1)
 ################################################################################
 # Environment Setup
 ################################################################################
@@ -92,6 +88,17 @@ except:
 
 gcndbfname = path.basename(gcndbosrv)
 
+try:
+  gcndbname = environ['GCNDBNAME']
+except:
+  gcndbname = "gcns"
+
+# gcn-export.py on GCNDBSRV
+try:
+  gcnexport = environ['GCNEXPORTOSRV']
+except:
+  gcnexport = 'gcn-export.py'
+
 # Location of web content on GCNDBSRV
 try:
   gcnwebosrv = environ['GCNWEBOSRV']
@@ -110,12 +117,19 @@ try:
   gcninter = float(environ['GCNINTER'])
 except:
   gcninter = 60
+
+# Maximum seconds added at random to each wait, so several daemons do not
+# poll the server in step
+try:
+  gcnjitter = float(environ['GCNJITTER'])
+except:
+  gcnjitter = 0.
 ################################################################################
 # App to run
 ################################################################################
 
 class App():
-  def __init__(self,log=devnull,inter=60,
+  def __init__(self,log=devnull,inter=60,jitter=0.,
                pidfile='/tmp/site-alerter-daemon.lock'):
     self.stdin_path = '/dev/null'
     self.stdout_path = log
@@ -123,61 +137,156 @@ class App():
     self.pidfile_path =  pidfile
     self.pidfile_timeout = inter+1
     self.umask = 0022
+    self.log = log
     self.inter = inter
-    self.modtime = None
+    self.jitter = jitter
+    self.replica = None
+    self.pushed = False
     self.buildsite = False
+    self.alerter = None
+    self.overruns = 0
+
   def run(self):
-    self.Check()
+    logging.basicConfig(filename=self.log,\
+                        format='%(asctime)s %(levelname)s: %(message)s',\
+                        filemode='a', level=logging.DEBUG)
+    # The files written are pushed back, so they are kept in the manifest
+    self.alerter = SiteAlerter(manifest=True)
+    # Cycles start every inter seconds, a cycle which overruns is followed at
+    # once by the next and the schedule restarts from then
+    nextstart = time.time()
+    while True:
+      try:
+        self.Check()
+      except:
+        logging.error('Cycle failed:\n%s'%traceback.format_exc())
+      now = time.time()
+      nextstart += self.inter
+      if now > nextstart:
+        self.overruns += 1
+        logging.warning('Cycle overran by %.1f s (%i overruns)'\
+                        %(now-nextstart,self.overruns))
+        nextstart = now
+      time.sleep(nextstart - now + random.uniform(0.,self.jitter))
 
   def UpdateDB(self):
     '''
-      Updates the local copy of the GCN DB
+      Applies the GCNs changed on the server since the last update to the
+      local copy of the GCN DB
     '''
+    if self.replica == None:
+      self.replica = GetGCNConfig('%s/%s'%(gcnweb,gcndbfname),gcndbname,
+                                  "writer")
+      if self.replica == None:
+        logging.error('Could not open %s/%s'%(gcnweb,gcndbfname))
+        return
+      # Build the site once at start
+      self.buildsite = True
+    seq = GetReplicaSeq(self.replica)
+    if seq == None:
+      logging.error('Could not read the replica state')
+      return
     devnullfobj = open(devnull,'w')
-    call(['rsync','-azq','%s:%s'%(gcndbsrv,gcndbosrv),'%s/'%gcnweb] ) #,\
-    #     stdout=devnullfobj,stderr=devnullfobj)
+    proc = Popen(['ssh',gcndbsrv,'GCNDB=%s'%gcndbosrv,gcnexport,str(seq)],\
+                 stdout=PIPE,stderr=devnullfobj)
+    try:
+      nrows, lastseq = ImportGCNs(self.replica,proc.stdout)
+    except:
+      logging.error('Failed to update from change %i:\n%s'\
+                    %(seq,traceback.format_exc()))
+      nrows = 0
+    proc.stdout.close()
+    status = proc.wait()
     devnullfobj.close()
-    if path.isfile('%s/%s'%(gcnweb,gcndbfname)):
-      cmt = path.getmtime('%s/%s'%(gcnweb,gcndbfname))
-      if self.modtime == None or self.modtime != cmt:
-        self.modtime = cmt
-        self.buildsite = True
-  
+    if status != 0:
+      logging.error('%s returned %i'%(gcnexport,status))
+      return
+    if nrows > 0:
+      logging.debug('Applied %i GCNs up to change %i'%(nrows,lastseq))
+      self.buildsite = True
+
   def SiteAlerter(self):
     '''
-      Calls site-alerter.py
+      Runs the site alerter, connecting to the DBs the first time
     '''
-    call(['%s/site-alerter.py'%pathname])
+    if self.alerter.dbcfg == None:
+      status = self.alerter.Open()
+      if status != 0:
+        self.alerter.Close()
+        return status
+    try:
+      return self.alerter.Run()
+    except:
+      # Start again from fresh connections next time
+      logging.error('site-alerter failed:\n%s'%traceback.format_exc())
+      self.alerter.Close()
+      return -1
 
 
   def PushBack(self):
     '''
-      Pushes generated web content back to DB server
+      Pushes the generated web content in the manifest back to DB server, or
+      all of it the first time
     '''
     devnullfobj = open(devnull,'w')
-    call(['rsync','-azq','--exclude=%s'%gcndbfname,\
-          '%s/'%gcnweb,\
-          '%s:%s'%(gcndbsrv,gcnwebosrv)],\
-         stdout=devnullfobj,stderr=devnullfobj)
+    if not self.pushed:
+      manifest, nbytes = ManifestRead()
+      # The replica comes with its -wal and -shm files, none are pushed
+      status = call(['rsync','-azq','--exclude=%s*'%gcndbfname,\
+                     '--exclude=%s'%path.basename(manifestfname),\
+                     '%s/'%gcnweb,\
+                     '%s:%s'%(gcndbsrv,gcnwebosrv)],\
+                    stdout=devnullfobj,stderr=devnullfobj)
+      devnullfobj.close()
+      if status != 0:
+        logging.error('rsync returned %i'%status)
+        return
+      self.pushed = True
+      if nbytes > 0:
+        ManifestDone(nbytes)
+      return
+    manifest, nbytes = ManifestRead()
+    if nbytes == 0:
+      devnullfobj.close()
+      logging.debug('Nothing to push')
+      return
+    # Files changed again since will be in the manifest again
+    fnames = [ fname for fname in sorted(manifest.keys()) \
+               if filehash('%s/%s'%(gcnweb,fname)) == manifest[fname] ]
+    if len(fnames) > 0:
+      proc = Popen(['rsync','-azq','--files-from=-',\
+                    '%s/'%gcnweb,\
+                    '%s:%s'%(gcndbsrv,gcnwebosrv)],\
+                   stdin=PIPE,stdout=devnullfobj,stderr=devnullfobj)
+      proc.communicate('\n'.join(fnames)+'\n')
+      if proc.returncode != 0:
+        devnullfobj.close()
+        logging.error('rsync returned %i'%proc.returncode)
+        return
     devnullfobj.close()
-  
+    logging.debug('Pushed %i files'%len(fnames))
+    ManifestDone(nbytes)
+
   def Check(self):
     '''
-      Function which calls itself every interval
+      Function which is called every interval
     '''
     self.UpdateDB()
-    if self.buildsite:
-      self.SiteAlerter()
-      self.PushBack()
+    # Also run without changes to alert on forecast windows as they open
+    if self.buildsite or gcnforecast > 0:
+      start = time.time()
+      status = self.SiteAlerter()
+      logging.debug('site-alerter returned %i in %.2f s'%(status,
+                                                          time.time()-start))
       self.buildsite = False
-    # Wait for inter then call again
-    time.sleep(self.inter)
-    self.Check()
+    # Also retries a failed push
+    self.PushBack()
 
 
 # Start daemon
 if __name__ == "__main__":
-  app = App(log=gcndaemonlog,inter=gcninter,pidfile=gcndaemonlock)
+  app = App(log=gcndaemonlog,inter=gcninter,jitter=gcnjitter,
+            pidfile=gcndaemonlock)
   daemon_runner = runner.DaemonRunner(app)
   daemon_runner.daemon_context.files_preserve=[gcndaemonlog]
   daemon_runner.do_action();
@@ -0,0 +1,1218 @@
+#!/usr/bin/env python
+################################################################################
+#  site_alerter.py
+#  Constructs a XML list of GCNs for each site and sends alerts. Used by
+#  site-alerter.py and, with its DB connections kept open between runs, by
+#  site-alerter-daemon.py and gcn-alertd.py.
+#
+#  Created by Brian Baughman on 3/4/13.
+#  Copyright 2013 Brian Baughman. All rights reserved.
+################################################################################
+################################################################################
+# Load needed modules
+################################################################################
+try:
+  import sys, re, time, logging, traceback, hashlib
+  from os import environ, path, _exit, makedirs, stat, access, R_OK, W_OK,\
+    rename, unlink, getpid
+except:
+  print 'Failed to load base modules'
+  sys.exit(-1)
+try:
+  try:
+    import xml.etree.ElementTree as ET
+  except:
+    try:
+      import elementtree.ElementTree as ET
+    except:
+      print 'Failed to load ElementTree'
+      _exit(-1)
+  from gcn_dbinterface import GetGCNConfig,GetConfig, MakeEntry, baseentry,\
+    gcninfo, QueryPlan, GetUpdateStr, InsertMany, CheckDB, LastChange,\
+    GetInsertStr, GetIndexStr, GetDBKeys, GetUniqueIndexStr, AddColumns
+  from gcn_catalog import gcncatalog, gcncatalogmax, GetCatalog
+  from smtp_outbox import GetOutboxConfig, OutboxRow, Drain, OutboxStats
+  from bitly import shorten
+  from timeConv import tjd2dttm, secInday, dttm2jd, TJD0, tjd2LST, sid2sol
+  from coordConv import *
+  from datetime import datetime
+  from numpy import deg2rad, rad2deg, array, arange, newaxis, zeros,\
+    concatenate, diff, nonzero, int8, errstate, pi, isnan
+  # Home directory
+  homedir = environ['HOME']
+  # stop if something looks wrong
+except:
+  print 'Failed to load modules'
+  _exit(-1)
+
+##############################################################################
+# Generic Settings
+##############################################################################
+# Update date format
+updfmt = '%Y-%m-%dT%H:%M:%S'
+# Subject of email format
+sbjctfmt = 'GCN at %s at %.f in FOV'
+# Content of email format
+txtfmt = '%s trigger %s was in the FOV at %.2f degrees from Zenith. Info at %s and %s'
+# Subject and content of emails for forecast windows (see Forecast)
+entersbjctfmt = 'GCN at %s entering FOV at %s'
+entertxtfmt = '%s trigger %s enters the FOV at %s, is %.2f degrees from Zenith at %s and leaves at %s. Info at %s and %s'
+# Catalog sources listed in the email
+matchhead = '\n\nCatalog sources in the error circle:'
+matchfmt = '\n%s at %.4f, %.4f, %.3f degrees away'
+# Define some regexes
+hrefre = re.compile("<[^>]*href=([^\ \"'>]+)>")
+################################################################################
+# Define DB structure
+################################################################################
+class alertinfo(baseentry):
+  def __init__(self):
+    self.id = "null"
+    # Read directly
+    self.trigid = "unset"
+    self.trig_tjd = 0
+    self.trig_sod = 0.
+    #    self.trig_date = "unset"
+    self.updated_date = "unset"
+    self.sent = 0
+    # Alerts made before sites were registered are for GCNSITE
+    self.site = sitetag
+    self.setDBType()
+
+# Indexes for looking up the alert of a GCN
+alertidxkeys = [ ["trig_tjd","trigid"] ]
+
+class cursorinfo(baseentry):
+  '''
+    Last entry of the GCN change log (see GetChangeLogStrs) processed, kept
+    in a single row with id 1
+  '''
+  def __init__(self):
+    self.id = "null"
+    self.gcnseq = 0
+    self.setDBType()
+
+class fragmentinfo(baseentry):
+  '''
+    Serialized XML of a GCN, id matches the GCN
+  '''
+  def __init__(self):
+    self.id = "null"
+    self.updated_date = "unset"
+    self.fragment = "unset"
+    self.setDBType()
+
+class matchinfo(baseentry):
+  '''
+    Source of the catalog (see gcn_catalog) within the error circle of a GCN
+  '''
+  def __init__(self):
+    self.id = "null"
+    self.trigid = "unset"
+    self.trig_tjd = 0
+    self.source = "unset"
+    self.ra = 0.
+    self.dec = 0.
+    self.dist = 0.
+    self.setDBType()
+
+class forecastinfo(baseentry):
+  '''
+    Position of a GCN for which its forecast windows were worked out
+  '''
+  def __init__(self):
+    self.id = "null"
+    self.trigid = "unset"
+    self.trig_tjd = 0
+    self.ra = 0.
+    self.dec = 0.
+    self.setDBType()
+
+class windowinfo(baseentry):
+  '''
+    Window of the forecast of a GCN (see Forecast) when it is in the FOV of
+    a site, times as TJD. sent is set once it was alerted on.
+  '''
+  def __init__(self):
+    self.id = "null"
+    self.trigid = "unset"
+    self.trig_tjd = 0
+    self.rise_tjd = 0.
+    self.transit_tjd = 0.
+    self.set_tjd = 0.
+    self.zenith = 0.
+    self.sent = 0
+    self.site = sitetag
+    self.setDBType()
+
+# Indexes for looking up the windows of a GCN and those to alert on
+windowidxkeys = [ ["trig_tjd","trigid"], ["sent","rise_tjd"] ]
+
+# XML around the gcn fragments
+xmlhead = '<xml version="1.0"><gcns>'
+xmltail = '</gcns></xml>'
+# Zenith angle at the trigger at the site of a feed, added to each GCN
+zenithfmt = '<zenith>%.2f</zenith>'
+gcntail = '</gcn>'
+# Version of the XML written, kept as the user_version of the alerts DB.
+# Cached fragments are dropped, and the XML written again, when it changes.
+fragversion = 2
+
+################################################################################
+# Useful functions
+################################################################################
+def dircheck(dir):
+  '''
+    Checks if the given directory exists, if not it attempts to create it.
+    '''
+  try:
+    stat(dir)
+  except:
+    makedirs(dir)
+  try:
+    stat(dir)
+    return True
+  except:
+    return False
+
+def gettxt(cinfo,curzen,sitetag,sitelink,matches=()):
+  '''
+    Generated formatted text for email alert, listing the given catalog
+    matches
+  '''
+  txt = txtfmt%(cinfo.inst.capitalize(),\
+                cinfo.trigid,\
+                curzen,\
+                shorten(cinfo.link),\
+                sitelink)
+  if len(matches) > 0:
+    txt += matchhead
+    for name, ra, dec, dist in matches:
+      txt += matchfmt%(name,ra,dec,dist)
+  return txt
+
+def getentertxt(cinfo,rise,transit,sett,zenith,sitelink):
+  '''
+    Generated formatted text for email alert of a forecast window
+  '''
+  tfmt = "%Y-%m-%d %H:%M:%S"
+  txt = entertxtfmt%(cinfo.inst.capitalize(),\
+                     cinfo.trigid,\
+                     tjd2dttm(rise).strftime(tfmt),\
+                     zenith,\
+                     tjd2dttm(transit).strftime(tfmt),\
+                     tjd2dttm(sett).strftime(tfmt),\
+                     shorten(cinfo.link),\
+                     sitelink)
+  return txt
+
+def ReadSites(fname):
+  '''
+    Reads a registry of sites, with a line for each giving its tag, latitude
+    and longitude in degrees, horizon (as GCNSITEHORIZON) and, optionally,
+    link. Lines starting with # are skipped. Returns a list of (tag, lat,
+    lon, horizon, link) with lat and lon in radians.
+  '''
+  sites = []
+  fin = open(fname,'r')
+  for line in fin:
+    fields = line.split()
+    if len(fields) == 0 or fields[0].startswith('#'):
+      continue
+    clink = sitelink
+    if len(fields) > 4:
+      clink = fields[4]
+    sites.append((fields[0],deg2rad(float(fields[1])),
+                  deg2rad(float(fields[2])),float(fields[3]),clink))
+  fin.close()
+  return sites
+
+def Zeniths(lat,lon,tjd,RA,dec):
+  '''
+    Returns the zenith angles, in degrees, of the sources at RA, dec at the
+    matching tjd from each site at lat, lon, as a sites x sources array.
+    Angles in radians.
+  '''
+  alt,az = eq2horzTJD(lat[:,newaxis],lon[:,newaxis],tjd,RA,dec)
+  return 90. - rad2deg(alt)
+
+def Forecast(tjd,RA,dec,hours,step,lat,lon,horizon):
+  '''
+    Returns, for each site at lat, lon (radians) and each source at RA, dec
+    (radians) from the matching tjd, the windows of the following hours when
+    the source is within horizon of the zenith at the site, as lists of
+    (rise, transit, set, zenith angle at transit) with times as TJD. The
+    zenith angles for all sites and sources are worked out at once on a grid
+    of step minutes. Rise and set are interpolated between points of the
+    grid, windows open at tjd or after hours are cut there.
+  '''
+  dt = step/(60.*24.)
+  tgrid = tjd[:,newaxis] + dt*arange(int(hours*60./step) + 1)
+  alt,az = eq2horzTJD(lat[:,newaxis,newaxis],lon[:,newaxis,newaxis],tgrid,
+                      RA[:,newaxis],dec[:,newaxis])
+  zen = 90. - rad2deg(alt)
+  # Sources without a position, nan, are never in the FOV
+  with errstate(invalid='ignore'):
+    vis = (zen < horizon[:,newaxis,newaxis]).astype(int8)
+  pad = zeros((len(lat),len(tjd),1),dtype=int8)
+  edges = diff(concatenate([pad,vis,pad],axis=2),axis=2)
+  # Grid points at which windows open, and after which they are closed, in
+  # order for each site and source so they pair up
+  ssite, srow, sidx = nonzero(edges == 1)
+  esite, erow, eidx = nonzero(edges == -1)
+  windows = [ [ [] for cindx in xrange(len(tjd)) ] \
+              for csite in xrange(len(lat)) ]
+  for csite, crow, cs, ce in zip(ssite,srow,sidx,eidx):
+    czen = zen[csite,crow]
+    ct = tgrid[crow]
+    chorizon = horizon[csite]
+    rise = ct[cs]
+    if cs > 0:
+      rise -= dt*(chorizon - czen[cs])/(czen[cs-1] - czen[cs])
+    sett = ct[ce-1]
+    if ce < len(ct):
+      sett += dt*(chorizon - czen[ce-1])/(czen[ce] - czen[ce-1])
+    # Transit is when the hour angle is 0, unless the window is cut first
+    ctransit = cs + czen[cs:ce].argmin()
+    transit = ct[ctransit]
+    zenith = czen[ctransit]
+    HA = (tjd2LST(transit,lon[csite]) - 12.*RA[crow]/pi + 12.)%24. - 12.
+    if rise <= transit - HA/(24.*sid2sol) <= sett:
+      transit -= HA/(24.*sid2sol)
+      zenith = abs(rad2deg(dec[crow] - lat[csite]))
+    windows[csite][crow].append((float(rise),float(transit),float(sett),
+                                 float(zenith)))
+  return windows
+
+def gcnfragment(curinfo,dbstruct):
+  '''
+    Returns the serialized XML of the given gcninfo
+  '''
+  curgcn = ET.Element("gcn")
+  for cattr in dbstruct.keys():
+    cursubelm = ET.SubElement(curgcn,cattr)
+    cval = curinfo.__getattribute__(cattr)
+    if cval == None:
+      cursubelm.text = "unset"
+    else:
+      cursubelm.text = str(cval)
+  cursubelm = ET.SubElement(curgcn,'trig_date')
+  evtTime = tjd2dttm(curinfo.trig_tjd + curinfo.trig_sod/secInday)
+  utt = evtTime.utctimetuple()
+  cursubelm.text = "%i-%02i-%02i %02i:%02i:%02i"%(utt.tm_year,utt.tm_mon,\
+                                                  utt.tm_mday,\
+                                                  utt.tm_hour,utt.tm_min,\
+                                                  utt.tm_sec)
+  return ET.tostring(curgcn)
+
+def filehash(fname,blocksize=65536):
+  '''
+    Returns the md5 of the contents of the given file, or None
+  '''
+  try:
+    fin = open(fname,'r')
+    chash = hashlib.md5()
+    for block in iter(lambda: fin.read(blocksize),''):
+      chash.update(block)
+    fin.close()
+    return chash.hexdigest()
+  except:
+    return None
+
+class feedwriter(object):
+  '''
+    Writes a file as it is generated to a temporary file next to it. close
+    renames the temporary file into place, so readers see either the old or
+    the new contents, unless the contents are unchanged.
+  '''
+  def __init__(self,fname):
+    self.fname = fname
+    self.tmpfname = '%s/.%s.%i'%(path.dirname(fname),path.basename(fname),
+                                 getpid())
+    self.fout = open(self.tmpfname,'w')
+    self.hash = hashlib.md5()
+  def write(self,txt):
+    self.fout.write(txt)
+    self.hash.update(txt)
+  def close(self):
+    '''
+      Returns True if the file was replaced
+    '''
+    self.fout.close()
+    if self.hash.hexdigest() == filehash(self.fname):
+      unlink(self.tmpfname)
+      return False
+    rename(self.tmpfname,self.fname)
+    return True
+  def abort(self):
+    self.fout.close()
+    unlink(self.tmpfname)
+
+def ManifestAdd(fname,fhash):
+  '''
+    Records that the given file under gcnweb was created or modified, with
+    the md5 of its new contents, so it is pushed to the web server
+  '''
+  fout = open(manifestfname,'a')
+  fout.write('%s  %s\n'%(fhash,path.relpath(fname,gcnweb)))
+  fout.close()
+
+def ManifestRead():
+  '''
+    Returns the files in the manifest, relative to gcnweb, with the md5 last
+    recorded for each, and the number of bytes read
+  '''
+  try:
+    fin = open(manifestfname,'r')
+  except IOError:
+    return {}, 0
+  manifest = {}
+  nbytes = 0
+  for line in fin:
+    # Only whole lines, one may be being written
+    if not line.endswith('\n'):
+      break
+    nbytes += len(line)
+    fhash, fname = line.rstrip('\n').split('  ',1)
+    manifest[fname] = fhash
+  fin.close()
+  return manifest, nbytes
+
+def ManifestDone(nbytes):
+  '''
+    Forgets the first nbytes of the manifest, once those files were pushed
+  '''
+  fin = open(manifestfname,'r')
+  fin.seek(nbytes)
+  rest = fin.read()
+  fin.close()
+  if rest == '':
+    unlink(manifestfname)
+    return
+  fout = open('%s.%i'%(manifestfname,getpid()),'w')
+  fout.write(rest)
+  fout.close()
+  rename('%s.%i'%(manifestfname,getpid()),manifestfname)
+
+################################################################################
+# Environment Settings
+################################################################################
+# GCN database
+try:
+  gcndbfname = environ['GCNDB']
+except:
+  gcndbfname = '%s/gcns.db'%homedir
+try:
+  gcndbname = environ['GCNDBNAME']
+except:
+  gcndbname = "gcns"
+# Alerts database
+try:
+  salertdbfname = environ['SALERTDB']
+except:
+  salertdbfname = '%s/alerts.db'%homedir
+try:
+  salertdbname = environ['SALERTDBNAME']
+except:
+  salertdbname = "alerts"
+
+# Alerts config
+try:
+  salertcfg = environ['SALERTCFG']
+except:
+  salertcfg = None
+# Log file name
+try:
+  salertlog = environ['SALERTLOG']
+except:
+  salertlog = '%s/logs/site-alerter.log'%homedir
+
+# Site Setup
+try:
+  sitetag = environ['GCNSITE']
+except:
+  sitetag = 'HAWC'
+try:
+  obslat = deg2rad(float(environ['GCNSITELAT']))
+except:
+  obslat = deg2rad(+19.0304954539937)
+try:
+  obslon = deg2rad(float(environ['GCNSITELONG']))
+except:
+  obslon = deg2rad(-97.2698484177274)
+try:
+  obshorizon = float(environ['GCNSITEHORIZON'])
+except:
+  obshorizon = float(45.000)
+# Registry of sites (see ReadSites), if unset the site above is the only one
+try:
+  gcnsites = environ['GCNSITES']
+except:
+  gcnsites = None
+# Hours after each GCN for which to forecast when it is in the FOV, 0 to not
+try:
+  gcnforecast = float(environ['GCNFORECAST'])
+except:
+  gcnforecast = 24.
+# Minutes between the times at which the forecast is worked out
+try:
+  gcnforecaststep = float(environ['GCNFORECASTSTEP'])
+except:
+  gcnforecaststep = 5.
+# Most GCNs forecast at once, which bounds the memory used when catching up
+try:
+  gcnforecastchunk = int(environ['GCNFORECASTCHUNK'])
+except:
+  gcnforecastchunk = 1000
+
+# Get web base, checked by Open
+try:
+  gcnhttp = environ['GCNHTTP']
+except:
+  gcnhttp = None
+
+# GCNSMTP, checked by Open
+try:
+  gcnsmtp = environ['GCNSMTP']
+except:
+  gcnsmtp = None
+# Number of SMTP connections used to send emails
+try:
+  gcnsmtpworkers = int(environ['GCNSMTPWORKERS'])
+except:
+  gcnsmtpworkers = 2
+# Attempts to send an email before giving up
+try:
+  gcnsmtptries = int(environ['GCNSMTPTRIES'])
+except:
+  gcnsmtptries = 5
+# Seconds before the first retry, doubled after each
+try:
+  gcnsmtpbackoff = float(environ['GCNSMTPBACKOFF'])
+except:
+  gcnsmtpbackoff = 60.
+
+# Get web base
+try:
+  gcnweb = environ['GCNWEB']
+except:
+  gcnweb = '%s/public_html'%homedir
+# Files under gcnweb changed and not yet pushed, see ManifestAdd. Only kept
+# for site-alerter-daemon, which pushes them and trims it.
+try:
+  manifestfname = environ['GCNMANIFEST']
+except:
+  manifestfname = '%s/.gcn-manifest'%homedir
+
+try:
+  sitelink = environ['GCNSITELINK']
+except:
+  sitelink = gcnhttp
+
+# Number of recent GCNs to output
+try:
+  nrecent = int(environ['NOUTGCNS'])
+except:
+  nrecent = 100
+
+################################################################################
+# Alerter
+################################################################################
+class SiteAlerter(object):
+  '''
+    Open connects to the DBs, then each call of Run updates the alerts and the
+    XML for the GCNs changed since the last call. The GCN DB is reopened if
+    its file is replaced, e.g. by rsync. With manifest set the files written
+    are recorded for pushing, see ManifestAdd.
+  '''
+  def __init__(self,manifest=False):
+    self.dbcfg = None
+    self.alertdbcfg = None
+    self.outboxcfg = None
+    self.gcndbino = None
+    # Catalog cross-matched with the GCNs, if any
+    self.catalog = None
+    # Tags of the sites, their positions and horizons as arrays, links, and
+    # the file of their feeds
+    self.sitetags = None
+    self.sitelat = None
+    self.sitelon = None
+    self.sitehorizon = None
+    self.sitelinks = None
+    self.feeds = None
+    # Set when the XML must be written even if no GCNs changed
+    self.rewrite = False
+    # Set when the files written are recorded in the manifest
+    self.manifest = manifest
+    # Sender of emails
+    self.sender = None
+    # Reciepents of email
+    self.recipients = None
+
+  def Open(self):
+    '''
+      Connects to the DBs and reads the alerts config. Returns 0 or the exit
+      status of site-alerter.
+    '''
+    ############################################################################
+    # Environment Settings
+    ############################################################################
+    if gcnhttp == None:
+      logging.error('GCNHTTP not set!')
+      return -2
+    if gcnsmtp == None:
+      logging.error( 'GCNSMTP not set!')
+      return -2
+    ############################################################################
+    # Alerts config
+    ############################################################################
+    # Read configuration file
+    try:
+      salertcfgif = open(salertcfg,'r')
+      cfglines = salertcfgif.readlines()
+      salertcfgif.close()
+      if len(cfglines) >= 2:
+        self.sender = cfglines[0].strip()
+        self.recipients = cfglines[1].strip().split(',')
+      if len(self.recipients) <=0 :
+        self.sender = None
+        self.recipients = None
+    except:
+      if salertcfg != None:
+        logging.error('Cannot read sender/recipients from: %s\n'%(salertcfg))
+        return -3
+      else:
+        logging.debug('No alerts will be sent')
+    ############################################################################
+    # Sites
+    ############################################################################
+    if gcnsites == None:
+      sites = [ (sitetag,obslat,obslon,obshorizon,sitelink) ]
+    else:
+      try:
+        sites = ReadSites(gcnsites)
+      except:
+        logging.error('Cannot read sites from: %s'%(gcnsites))
+        return -3
+    self.sitetags = [ csite[0] for csite in sites ]
+    if len(sites) == 0 or len(set(self.sitetags)) != len(sites):
+      logging.error('No sites, or several with one tag, in: %s'%(gcnsites))
+      return -3
+    self.sitelat = array([ csite[1] for csite in sites ],dtype=float)
+    self.sitelon = array([ csite[2] for csite in sites ],dtype=float)
+    self.sitehorizon = array([ csite[3] for csite in sites ],dtype=float)
+    self.sitelinks = dict([ (csite[0],csite[4]) for csite in sites ])
+    # A feed for each site, in a directory of its own if there are several
+    if len(sites) == 1:
+      self.feeds = [ '%s/gcns.xml'%gcnweb ]
+    else:
+      self.feeds = [ '%s/%s/gcns.xml'%(gcnweb,ctag) for ctag in self.sitetags ]
+    logging.debug('Sites: %s'%(', '.join(self.sitetags)))
+    ############################################################################
+    # Get Alerts Database
+    ############################################################################
+    try:
+      self.alertdbcfg = GetConfig(salertdbfname,salertdbname,alertinfo,
+                                  idxkeys=alertidxkeys)
+    except:
+      logging.error('Could not read %s'%salertdbname)
+      return -1
+    if self.alertdbcfg == None:
+      logging.info('Alert DB failed to initialize.')
+      return -1
+    alertdbcfg = self.alertdbcfg
+    # Outbox of emails, in the alerts database
+    self.outboxcfg = GetOutboxConfig(salertdbfname,'%s_outbox'%salertdbname)
+    if self.outboxcfg == None:
+      logging.info('Outbox failed to initialize.')
+      return -1
+    # Cursor into the GCN change log, kept with the alerts
+    self.cursordbname = '%s_cursor'%alertdbcfg.dbname
+    if CheckDB(alertdbcfg.curs,self.cursordbname,
+               cursorinfo().__dbstruct__) == None:
+      logging.error('Could not read %s'%self.cursordbname)
+      return -1
+    self.cursorstr = "INSERT OR REPLACE INTO %s (id,gcnseq) VALUES (1,?);"\
+      %self.cursordbname
+    # Serialized GCNs are cached with the alerts
+    self.fragdbname = '%s_fragments'%alertdbcfg.dbname
+    if CheckDB(alertdbcfg.curs,self.fragdbname,
+               fragmentinfo().__dbstruct__) == None:
+      logging.error('Could not read %s'%self.fragdbname)
+      return -1
+    alertdbcfg.curs.execute("PRAGMA user_version;")
+    if alertdbcfg.curs.fetchone()[0] != fragversion:
+      logging.info('Dropping XML cached by another version')
+      alertdbcfg.curs.execute("DELETE FROM %s;"%self.fragdbname)
+      alertdbcfg.curs.execute("PRAGMA user_version=%i;"%fragversion)
+      alertdbcfg.dbconn.commit()
+      self.rewrite = True
+    # Catalog sources matching each GCN are kept with the alerts
+    self.matchdbname = '%s_matches'%alertdbcfg.dbname
+    matchstruct = CheckDB(alertdbcfg.curs,self.matchdbname,
+                          matchinfo().__dbstruct__)
+    if matchstruct == None:
+      logging.error('Could not read %s'%self.matchdbname)
+      return -1
+    for cidxkeys in alertidxkeys:
+      alertdbcfg.curs.execute(GetIndexStr(self.matchdbname,cidxkeys))
+    alertdbcfg.dbconn.commit()
+    self.matchkeys = GetDBKeys(matchstruct)
+    self.matchinststr = GetInsertStr(self.matchdbname,matchstruct)
+    if gcncatalog != None and self.catalog == None:
+      try:
+        self.catalog = GetCatalog(gcncatalog)
+        logging.info('Cross-matching with %i sources of %s'\
+                     %(len(self.catalog),gcncatalog))
+      except:
+        # Alerts are still sent, without matches
+        logging.error('Could not read catalog %s:\n%s'\
+                      %(gcncatalog,traceback.format_exc()))
+    # Forecasts of when GCNs are in the FOV are kept with the alerts
+    self.fcdbname = '%s_forecasts'%alertdbcfg.dbname
+    fcstruct = CheckDB(alertdbcfg.curs,self.fcdbname,
+                       forecastinfo().__dbstruct__)
+    if fcstruct == None:
+      logging.error('Could not read %s'%self.fcdbname)
+      return -1
+    self.windbname = '%s_windows'%alertdbcfg.dbname
+    winstruct = CheckDB(alertdbcfg.curs,self.windbname,
+                        windowinfo().__dbstruct__)
+    if winstruct == None:
+      logging.error('Could not read %s'%self.windbname)
+      return -1
+    try:
+      winstruct = AddColumns(alertdbcfg.curs,self.windbname,winstruct,
+                             windowinfo())
+    except:
+      logging.error('Could not update %s'%self.windbname)
+      return -1
+    for cidxkeys in alertidxkeys:
+      alertdbcfg.curs.execute(GetUniqueIndexStr(self.fcdbname,cidxkeys))
+    for cidxkeys in windowidxkeys:
+      alertdbcfg.curs.execute(GetIndexStr(self.windbname,cidxkeys))
+    alertdbcfg.dbconn.commit()
+    self.fckeys = GetDBKeys(fcstruct)
+    self.fcinststr = "INSERT OR REPLACE INTO %s (%s) VALUES (%s);"\
+      %(self.fcdbname,','.join(self.fckeys),','.join(['?']*len(self.fckeys)))
+    self.winkeys = GetDBKeys(winstruct)
+    self.wininststr = GetInsertStr(self.windbname,winstruct)
+    self.winsentstr = GetUpdateStr(self.windbname,["sent"],["id"])
+    alertkeys = ["trig_tjd","trigid"]
+    keycond = ' and '.join(['%s=?'%cattr for cattr in alertkeys])
+    self.matchdelstr = "DELETE FROM %s WHERE %s;"%(self.matchdbname,keycond)
+    self.windelstr = "DELETE FROM %s WHERE %s;"%(self.windbname,keycond)
+    self.winsentselstr = "SELECT site, rise_tjd, set_tjd FROM %s"\
+      %self.windbname
+    self.winsentselstr += " WHERE %s AND sent=1;"%keycond
+    self.updalertstr = GetUpdateStr(alertdbcfg.dbname,["updated_date"],
+                                    alertkeys+["site"])
+    self.sentalertstr = GetUpdateStr(alertdbcfg.dbname,["sent"],
+                                     alertkeys+["site"])
+    return self.OpenGCNDB()
+
+  def OpenGCNDB(self):
+    '''
+      Connects to the GCN DB, with the alerts DB attached, and builds the
+      queries used by Run. Returns 0 or the exit status of site-alerter.
+    '''
+    if self.dbcfg != None:
+      self.dbcfg.curs.close()
+      self.dbcfg.dbconn.close()
+      self.dbcfg = None
+    ############################################################################
+    # Get GCN Database
+    ############################################################################
+    try:
+      self.gcndbino = stat(gcndbfname).st_ino
+      dbcfg = GetGCNConfig(gcndbfname,gcndbname,"reader")
+    except:
+      logging.error('Could not read %s'%gcndbname)
+      return -1
+    if dbcfg == None:
+      logging.info('GCN DB failed to initialize.')
+      return -1
+    self.dbcfg = dbcfg
+    # Read alerts through the GCN DB connection so each GCN and its alert come
+    # back from one query
+    try:
+      dbcfg.curs.execute("ATTACH DATABASE ? AS alertdb;",(salertdbfname,))
+    except:
+      logging.error('Could not attach %s'%salertdbfname)
+      return -1
+    self.recentsel = "SELECT * FROM %s ORDER BY trig_tjd DESC, trig_sod DESC LIMIT ?"%(dbcfg.dbname)
+    # Recents with their alerts, if any
+    self.ngcncols = len(dbcfg.dbstruct)
+    self.changedstr = "SELECT g.*, a.id, a.updated_date, a.sent, a.site,"
+    self.changedstr += " f.ra, f.dec FROM (%s) AS g"%self.recentsel
+    self.changedstr += " LEFT JOIN alertdb.%s AS a"%(self.alertdbcfg.dbname)
+    self.changedstr += " ON a.trig_tjd=g.trig_tjd AND a.trigid=g.trigid"
+    self.changedstr += " LEFT JOIN alertdb.%s AS f"%(self.fcdbname)
+    self.changedstr += " ON f.trig_tjd=g.trig_tjd AND f.trigid=g.trigid"
+    # Forecast windows open now and not yet alerted on, with their GCNs
+    self.enteringstr = "SELECT g.*, w.id, w.rise_tjd, w.transit_tjd,"
+    self.enteringstr += " w.set_tjd, w.zenith, w.site FROM alertdb.%s AS w"\
+      %self.windbname
+    self.enteringstr += " JOIN %s AS g"%dbcfg.dbname
+    self.enteringstr += " ON g.trig_tjd=w.trig_tjd AND g.trigid=w.trigid"
+    self.enteringstr += " WHERE w.sent=0 AND w.rise_tjd<=? AND w.set_tjd>?"
+    self.enteringstr += " ORDER BY w.rise_tjd;"
+    # Recents with their cached XML
+    self.fragstr = "SELECT g.*, f.updated_date, f.fragment FROM (%s) AS g"\
+      %self.recentsel
+    self.fragstr += " LEFT JOIN alertdb.%s AS f ON f.id=g.id;"%self.fragdbname
+    self.fraginststr = "INSERT OR REPLACE INTO alertdb.%s"%self.fragdbname
+    self.fraginststr += " (id,updated_date,fragment) VALUES (?,?,?);"
+    self.fragdelstr = "DELETE FROM alertdb.%s"%self.fragdbname
+    self.fragdelstr += " WHERE id NOT IN (SELECT id FROM (%s));"%self.recentsel
+    return 0
+
+  def Close(self):
+    '''
+      Closes the DB connections
+    '''
+    for cfg in [self.dbcfg,self.alertdbcfg,self.outboxcfg]:
+      try:
+        cfg.curs.close()
+        cfg.dbconn.commit()
+        cfg.dbconn.close()
+      except:
+        pass
+    self.dbcfg = None
+    self.alertdbcfg = None
+    self.outboxcfg = None
+
+  def Run(self):
+    '''
+      Alerts on and outputs the GCNs changed since the last run. Returns 0 or
+      the exit status of site-alerter.
+    '''
+    try:
+      replaced = stat(gcndbfname).st_ino != self.gcndbino
+    except:
+      replaced = True
+    if replaced:
+      logging.info('Reopening %s'%gcndbfname)
+      status = self.OpenGCNDB()
+      if status != 0:
+        return status
+    self.Alert()
+    return self.Output()
+
+  def Alert(self):
+    '''
+      Checks the GCNs changed since the last run, queues alerts for those in
+      the FOV and sends the queued emails
+    '''
+    dbcfg = self.dbcfg
+    alertdbcfg = self.alertdbcfg
+    outboxcfg = self.outboxcfg
+    alertdbcfg.curs.execute("SELECT gcnseq FROM %s WHERE id=1;"\
+                            %self.cursordbname)
+    gcncursor = alertdbcfg.curs.fetchone()
+    # Changes logged after this are left for the next run
+    lastseq = LastChange(dbcfg)
+    self.changed = gcncursor == None or gcncursor[0] != lastseq
+
+    # Grab recents inserted or updated since the last run, all of them on the
+    # first run, with their alerts, if any
+    a_id = self.ngcncols
+    a_updated_date = self.ngcncols + 1
+    a_sent = self.ngcncols + 2
+    a_site = self.ngcncols + 3
+    f_ra = self.ngcncols + 4
+    f_dec = self.ngcncols + 5
+    changedstr = self.changedstr
+    changedargs = (nrecent,)
+    if gcncursor != None:
+      changedstr += " WHERE g.id IN (SELECT id FROM %s"%(dbcfg.chgname)
+      changedstr += " WHERE seq > ? AND seq <= ?)"
+      changedargs = (nrecent,gcncursor[0],lastseq)
+    changedstr += " ORDER BY g.trig_tjd DESC, g.trig_sod DESC, g.id DESC;"
+    # Report how the query is run
+    logging.debug('%s : %s'%(changedstr,
+                  '; '.join(QueryPlan(dbcfg.curs,changedstr,changedargs))))
+    dbcfg.curs.execute(changedstr,changedargs)
+    changed = dbcfg.curs.fetchall()
+    # Collect the alerts of each GCN, keeping the query order
+    g_id = dbcfg.dbstruct['id']['index']
+    changedalerts = []
+    for row in changed:
+      if len(changedalerts) == 0 or changedalerts[-1][0][g_id] != row[g_id]:
+        changedalerts.append([row])
+      else:
+        changedalerts[-1].append(row)
+    logging.debug('%i GCNs changed since change %s'%(len(changedalerts),
+                                                      gcncursor))
+
+    # Changes to the alerts DB, written together once all GCNs are checked
+    newalerts = []
+    updalerts = []
+    sentalerts = []
+    delmatches = []
+    newmatches = []
+    newforecasts = []
+    delwindows = []
+    newwindows = []
+    emails = []
+    sbjcts = []
+    # Calculate positions at every site of all changed GCNs at once
+    g_tjd = dbcfg.dbstruct['trig_tjd']['index']
+    g_sod = dbcfg.dbstruct['trig_sod']['index']
+    g_ra = dbcfg.dbstruct['ra']['index']
+    g_dec = dbcfg.dbstruct['dec']['index']
+    evtTJD = array([ camtchs[0][g_tjd] + camtchs[0][g_sod]/secInday \
+                     for camtchs in changedalerts ],dtype=float)
+    # GCNs without a position, NULL so nan, are never in the FOV
+    evtRA = deg2rad(array([ camtchs[0][g_ra] \
+                            for camtchs in changedalerts ],dtype=float))
+    evtDec = deg2rad(array([ camtchs[0][g_dec] \
+                             for camtchs in changedalerts ],dtype=float))
+    evtdZeniths = Zeniths(self.sitelat,self.sitelon,evtTJD,evtRA,evtDec)
+    # Forecast when GCNs whose position is new or changed will be in the FOV
+    # of each site, unless the forecast would already be over
+    nowtjd = dttm2jd(datetime.utcnow()) - TJD0
+    fcindx = [ cindx for cindx,camtchs in enumerate(changedalerts) \
+               if camtchs[0][g_ra] != None and camtchs[0][g_dec] != None and \
+               (camtchs[0][f_ra] != camtchs[0][g_ra] or \
+                camtchs[0][f_dec] != camtchs[0][g_dec]) and \
+               evtTJD[cindx] + gcnforecast/24. > nowtjd ]
+    forecasts = {}
+    if gcnforecast <= 0:
+      fcindx = []
+    for cstart in xrange(0,len(fcindx),gcnforecastchunk):
+      cfcindx = fcindx[cstart:cstart + gcnforecastchunk]
+      fcwindows = Forecast(evtTJD[cfcindx],evtRA[cfcindx],evtDec[cfcindx],
+                           gcnforecast,gcnforecaststep,self.sitelat,
+                           self.sitelon,self.sitehorizon)
+      for findx, cindx in enumerate(cfcindx):
+        forecasts[cindx] = [ cwindows[findx] for cwindows in fcwindows ]
+    if len(fcindx) > 0:
+      logging.debug('Forecast %i GCNs'%len(fcindx))
+    for cindx,camtchs in enumerate(changedalerts):
+      curinfo = MakeEntry(camtchs[0],gcninfo,dbcfg.dbstruct)
+      akey = (curinfo.trig_tjd,curinfo.trigid)
+      # Alerts of this GCN at each site
+      sitealerts = {}
+      for row in camtchs:
+        if row[a_id] != None:
+          sitealerts.setdefault(row[a_site],[]).append(row)
+
+      # Catalog sources in the error circle, replacing any found before
+      matches = []
+      if self.catalog != None and curinfo.ra != None and curinfo.dec != None:
+        try:
+          matches = self.catalog.Match(curinfo.ra,curinfo.dec,
+                                       curinfo.error or 0.,gcncatalogmax)
+          delmatches.append(akey)
+        except:
+          logging.error('Failed to cross-match %s:\n%s'\
+                        %(curinfo.trigid,traceback.format_exc()))
+        for name, ra, dec, dist in matches:
+          nMatch = matchinfo()
+          nMatch.trigid = curinfo.trigid
+          nMatch.trig_tjd = curinfo.trig_tjd
+          nMatch.source = name
+          nMatch.ra = ra
+          nMatch.dec = dec
+          nMatch.dist = dist
+          newmatches.append([nMatch.__getattribute__(cattr) \
+                             for cattr in self.matchkeys ])
+        if len(matches) > 0:
+          logging.debug('%i catalog sources match %s'%(len(matches),
+                                                       curinfo.trigid))
+
+      # Forecast windows, replacing those for the previous position
+      if cindx in forecasts:
+        nForecast = forecastinfo()
+        nForecast.trigid = curinfo.trigid
+        nForecast.trig_tjd = curinfo.trig_tjd
+        nForecast.ra = curinfo.ra
+        nForecast.dec = curinfo.dec
+        newforecasts.append([nForecast.__getattribute__(cattr) \
+                             for cattr in self.fckeys ])
+        delwindows.append(akey)
+        # Windows already alerted on for the previous position, so the
+        # windows they overlap are not alerted on again
+        alertdbcfg.curs.execute(self.winsentselstr,akey)
+        sentwins = alertdbcfg.curs.fetchall()
+        for sindx, ctag in enumerate(self.sitetags):
+          for rise, transit, sett, zenith in forecasts[cindx][sindx]:
+            nWindow = windowinfo()
+            nWindow.trigid = curinfo.trigid
+            nWindow.trig_tjd = curinfo.trig_tjd
+            nWindow.rise_tjd = rise
+            nWindow.transit_tjd = transit
+            nWindow.set_tjd = sett
+            nWindow.zenith = zenith
+            # In the FOV at the trigger, so alerted on below, or already
+            # alerted on
+            nWindow.sent = int(rise <= evtTJD[cindx] or \
+                               any([ wsite == ctag and rise < wset and \
+                                     sett > wrise \
+                                     for wsite, wrise, wset in sentwins ]))
+            nWindow.site = ctag
+            newwindows.append([nWindow.__getattribute__(cattr) \
+                               for cattr in self.winkeys ])
+        logging.debug('%i forecast windows for %s'\
+                      %(sum([ len(cwindows) for cwindows in forecasts[cindx] ]),
+                        curinfo.trigid))
+
+      for sindx, ctag in enumerate(self.sitetags):
+        skey = akey + (ctag,)
+        # Check if this entry has been updated
+        upd = False
+        sentflg = 0
+        calerts = sitealerts.get(ctag,[])
+        if len(calerts) == 0:
+          '''
+            Add new entry
+          '''
+          nAlert = alertinfo()
+          nAlert.trigid = curinfo.trigid
+          nAlert.trig_tjd = curinfo.trig_tjd
+          nAlert.trig_sod = curinfo.trig_sod
+          nAlert.updated_date = curinfo.updated_date
+          nAlert.sent = 0
+          nAlert.site = ctag
+          newalerts.append([nAlert.__getattribute__(cattr) \
+                            for cattr in alertdbcfg.instkeys ])
+          upd = True
+        elif len(calerts) > 1:
+          '''
+            This should never happen so assume it is an error and skip
+          '''
+          logging.info('Found multiple entries for %s at %s'\
+                       %(curinfo.trigid,ctag))
+          continue
+        else:
+          rEUD = str(curinfo.updated_date).replace('T',' ')
+          mEUD = str(calerts[0][a_updated_date]).replace('T',' ')
+          if rEUD > mEUD:
+            upd = True
+            updalerts.append((curinfo.updated_date,)+skey)
+          sentflg += calerts[0][a_sent]
+
+        evtdZenith = evtdZeniths[sindx,cindx]
+        if upd:
+          logging.debug("Updated %s at %s"%(curinfo.trigid,ctag))
+
+        if evtdZenith < self.sitehorizon[sindx] and sentflg == 0:
+          evtTime = tjd2dttm(evtTJD[cindx])
+          sbjct = sbjctfmt%(evtTime.strftime("%Y-%m-%d %H:%M:%S"),evtdZenith)
+          if len(self.sitetags) > 1:
+            sbjct = '%s %s'%(ctag,sbjct)
+          txt = gettxt(curinfo,evtdZenith,ctag,self.sitelinks[ctag],matches)
+          sentalerts.append((1,)+skey)
+          if self.sender != None:
+            emails.append(OutboxRow(outboxcfg,self.sender,self.recipients,
+                                    sbjct,txt))
+            sbjcts.append(sbjct)
+          else:
+            logging.info( 'Not sent: %s'%(sbjct))
+
+    # Record new, updated and sent alerts in one transaction, with their
+    # emails queued in the outbox. An alert is only marked sent with its
+    # email queued.
+    try:
+      InsertMany(alertdbcfg,newalerts)
+      alertdbcfg.curs.executemany(self.updalertstr,updalerts)
+      alertdbcfg.curs.executemany(self.sentalertstr,sentalerts)
+      alertdbcfg.curs.executemany(self.matchdelstr,delmatches)
+      alertdbcfg.curs.executemany(self.matchinststr,newmatches)
+      alertdbcfg.curs.executemany(self.fcinststr,newforecasts)
+      alertdbcfg.curs.executemany(self.windelstr,delwindows)
+      alertdbcfg.curs.executemany(self.wininststr,newwindows)
+      alertdbcfg.curs.executemany(outboxcfg.inststr,emails)
+      alertdbcfg.curs.execute(self.cursorstr,(lastseq,))
+      alertdbcfg.dbconn.commit()
+      for sbjct in sbjcts:
+        logging.info( 'Queued: %s'%(sbjct))
+    except:
+      alertdbcfg.dbconn.rollback()
+      logging.error( 'Failed to update Alert DB:\n%s'%traceback.format_exc())
+    # Alert on forecast windows opened since the last run
+    self.Entering()
+    # Send queued emails, including those to retry from earlier runs
+    try:
+      nsent, nretry, nfailed = Drain(outboxcfg,gcnsmtp,gcnsmtpworkers,
+                                     gcnsmtptries,gcnsmtpbackoff)
+      depth, oldest, latency = OutboxStats(outboxcfg)
+      logging.info( 'Outbox: %i sent, %i to retry, %i failed, %i queued'\
+                    %(nsent,nretry,nfailed,depth))
+      if latency != None:
+        logging.debug('Outbox latency %.2f s'%latency)
+    except:
+      logging.error( 'Failed to send notifications:\n%s'%traceback.format_exc())
+
+  def Entering(self):
+    '''
+      Queues alerts for the forecast windows which are open and were not
+      alerted on yet. Windows which closed before a run are skipped.
+    '''
+    dbcfg = self.dbcfg
+    alertdbcfg = self.alertdbcfg
+    outboxcfg = self.outboxcfg
+    nowtjd = dttm2jd(datetime.utcnow()) - TJD0
+    dbcfg.curs.execute(self.enteringstr,(nowtjd,nowtjd))
+    entering = dbcfg.curs.fetchall()
+    if len(entering) == 0:
+      return
+    w_id = self.ngcncols
+    sentwindows = []
+    emails = []
+    sbjcts = []
+    for row in entering:
+      curinfo = MakeEntry(row,gcninfo,dbcfg.dbstruct)
+      rise, transit, sett, zenith, ctag = row[w_id+1:w_id+6]
+      # Sites no longer registered are not alerted on
+      if ctag not in self.sitelinks:
+        continue
+      evtTime = tjd2dttm(curinfo.trig_tjd + curinfo.trig_sod/secInday)
+      sbjct = entersbjctfmt%(evtTime.strftime("%Y-%m-%d %H:%M:%S"),
+                             tjd2dttm(rise).strftime("%Y-%m-%d %H:%M:%S"))
+      if len(self.sitetags) > 1:
+        sbjct = '%s %s'%(ctag,sbjct)
+      txt = getentertxt(curinfo,rise,transit,sett,zenith,self.sitelinks[ctag])
+      sentwindows.append((1,row[w_id]))
+      if self.sender != None:
+        emails.append(OutboxRow(outboxcfg,self.sender,self.recipients,
+                                sbjct,txt))
+        sbjcts.append(sbjct)
+      else:
+        logging.info( 'Not sent: %s'%(sbjct))
+    # A window is only marked sent with its email queued
+    try:
+      alertdbcfg.curs.executemany(self.winsentstr,sentwindows)
+      alertdbcfg.curs.executemany(outboxcfg.inststr,emails)
+      alertdbcfg.dbconn.commit()
+      for sbjct in sbjcts:
+        logging.info( 'Queued: %s'%(sbjct))
+    except:
+      alertdbcfg.dbconn.rollback()
+      logging.error( 'Failed to update Alert DB:\n%s'%traceback.format_exc())
+
+  def Output(self):
+    '''
+      Writes the XML of the recent GCNs for each site, in one pass over them,
+      if any changed. Returns 0 or the exit status of site-alerter.
+    '''
+    dbcfg = self.dbcfg
+    # The XML only changes with the GCNs
+    if not self.changed and not self.rewrite and \
+      all([ path.exists(xmlfname) for xmlfname in self.feeds ]):
+      logging.debug('No GCNs changed, XML left as is')
+      return 0
+
+    # Only GCNs updated since they were cached are serialized again
+    g_id = dbcfg.dbstruct['id']['index']
+    g_updated_date = dbcfg.dbstruct['updated_date']['index']
+    g_tjd = dbcfg.dbstruct['trig_tjd']['index']
+    g_sod = dbcfg.dbstruct['trig_sod']['index']
+    g_ra = dbcfg.dbstruct['ra']['index']
+    g_dec = dbcfg.dbstruct['dec']['index']
+    f_updated_date = self.ngcncols
+    f_fragment = self.ngcncols + 1
+    # GCNs are written to the XML as they are read, fragbatch at a time, new
+    # fragments are cached through a second cursor after each batch
+    fragbatch = 1000
+    fragcurs = dbcfg.dbconn.cursor()
+    nfrags = 0
+    nnewfrags = 0
+    newfrags = []
+    cachefrags = True
+    feeds = []
+    try:
+      for xmlfname in self.feeds:
+        if not dircheck(path.dirname(xmlfname)):
+          raise IOError
+        feeds.append(feedwriter(xmlfname))
+    except:
+      for feed in feeds:
+        feed.abort()
+      logging.error( 'Failed to open output XML file: %s'%(xmlfname))
+      return -6
+    try:
+      for feed in feeds:
+        feed.write(xmlhead)
+      dbcfg.curs.execute(self.fragstr,(nrecent,))
+      while True:
+        rows = dbcfg.curs.fetchmany(fragbatch)
+        if len(rows) == 0:
+          break
+        # Zenith angles at the trigger at every site of the whole batch
+        evtTJD = array([ row[g_tjd] + row[g_sod]/secInday for row in rows ],
+                       dtype=float)
+        evtRA = deg2rad(array([ row[g_ra] for row in rows ],dtype=float))
+        evtDec = deg2rad(array([ row[g_dec] for row in rows ],dtype=float))
+        evtdZeniths = Zeniths(self.sitelat,self.sitelon,evtTJD,evtRA,evtDec)
+        for rindx, row in enumerate(rows):
+          nfrags += 1
+          if row[f_fragment] != None and \
+            row[f_updated_date] == row[g_updated_date]:
+            curfrag = row[f_fragment]
+          else:
+            curinfo = MakeEntry(row,gcninfo,dbcfg.dbstruct)
+            curfrag = gcnfragment(curinfo,dbcfg.dbstruct)
+            nnewfrags += 1
+            if cachefrags:
+              newfrags.append((row[g_id],row[g_updated_date],curfrag))
+          # The fragment is shared by the sites, only the zenith angle
+          # differs
+          curfrag = curfrag[:-len(gcntail)]
+          for sindx, feed in enumerate(feeds):
+            evtdZenith = evtdZeniths[sindx,rindx]
+            if isnan(evtdZenith):
+              feed.write('%s<zenith>unset</zenith>%s'%(curfrag,gcntail))
+            else:
+              feed.write('%s%s%s'%(curfrag,zenithfmt%evtdZenith,gcntail))
+        if cachefrags and len(newfrags) > 0:
+          try:
+            fragcurs.executemany(self.fraginststr,newfrags)
+          except:
+            cachefrags = False
+            logging.error( 'Failed to cache XML:\n%s'%traceback.format_exc())
+          newfrags = []
+      for feed in feeds:
+        feed.write(xmltail)
+    except:
+      for feed in feeds:
+        feed.abort()
+      logging.error( 'Failed to write output XML files:\n%s'\
+                     %traceback.format_exc())
+      return -6
+    logging.debug('Serialized %i of %i GCNs'%(nnewfrags,nfrags))
+    # Forget GCNs no longer output
+    if cachefrags:
+      try:
+        fragcurs.execute(self.fragdelstr,(nrecent,))
+        dbcfg.dbconn.commit()
+      except:
+        cachefrags = False
+        logging.error( 'Failed to cache XML:\n%s'%traceback.format_exc())
+    if not cachefrags:
+      dbcfg.dbconn.rollback()
+    fragcurs.close()
+
+    # Save XML, if changed
+    status = 0
+    for feed in feeds:
+      try:
+        replaced = feed.close()
+      except:
+        logging.error( 'Failed to write output XML file: %s'%(feed.fname))
+        status = -6
+        continue
+      if not replaced:
+        logging.debug('XML unchanged: %s'%(feed.fname))
+        continue
+      logging.info( 'Updated XML: %s'%(feed.fname))
+      if not self.manifest:
+        continue
+      try:
+        ManifestAdd(feed.fname,feed.hash.hexdigest())
+      except:
+        logging.error( 'Failed to add to manifest: %s'%(manifestfname))
+    if status == 0:
+      self.rewrite = False
+    return status
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+################################################################################
+#  smtp_outbox.py
+#  Queue of emails kept in a sqlite DB and sent by a pool of workers, each
+#  reusing one SMTP connection. Failed emails are retried with exponential
+#  backoff.
+################################################################################
+try:
+  import sys, logging, threading, Queue, smtplib
+  from email import MIMEText
+  from time import time
+  from os import environ, _exit
+  from sql_interface import GetConfig, baseentry
+  # Home directory
+  homedir = environ['HOME']
+except:
+  print 'Failed to load modules'
+  _exit(-1)
+
+# Seconds an email is held by the process sending it
+outboxlease = 300.
+
+################################################################################
+# Define DB structure
+################################################################################
+class outboxinfo(baseentry):
+  def __init__(self):
+    self.id = "null"
+    self.sender = "unset"
+    # Comma separated
+    self.recipients = "unset"
+    self.subject = "unset"
+    self.text = "unset"
+    # queued, sent or failed
+    self.status = "queued"
+    self.attempts = 0
+    self.error = ""
+    # Times in seconds since the epoch
+    self.queued = 0.
+    self.next_try = 0.
+    self.sent_time = 0.
+    self.setDBType()
+
+# Indexes for finding emails due
+outboxidxkeys = [ ["status","next_try"] ]
+
+################################################################################
+# Useful functions
+################################################################################
+def GetOutboxConfig(dbfname,dbname):
+  return GetConfig(dbfname,dbname,outboxinfo,idxkeys=outboxidxkeys)
+
+def OutboxRow(cfg,sender,recipients,subject,text):
+  '''
+    Returns a new email as a tuple ordered as cfg.instkeys, for inststr
+  '''
+  nEmail = outboxinfo()
+  nEmail.sender = sender
+  if hasattr(recipients,'__iter__'):
+    nEmail.recipients = ','.join(recipients)
+  else:
+    nEmail.recipients = recipients
+  nEmail.subject = subject
+  nEmail.text = text
+  nEmail.queued = time()
+  nEmail.next_try = nEmail.queued
+  return tuple([ nEmail.__getattribute__(cattr) for cattr in cfg.instkeys ])
+
+def Enqueue(cfg,sender,recipients,subject,text,commit=True):
+  '''
+    Adds an email to the outbox and returns its id
+  '''
+  cfg.curs.execute(cfg.inststr,OutboxRow(cfg,sender,recipients,subject,text))
+  if commit:
+    cfg.dbconn.commit()
+  return cfg.curs.lastrowid
+
+def Claim(cfg,now,limit=None):
+  '''
+    Returns the queued emails due, which are held for outboxlease seconds
+    so no other process sends them
+  '''
+  cfg.curs.execute("BEGIN IMMEDIATE;")
+  try:
+    ckstr = "SELECT * FROM %s WHERE status='queued' AND next_try<=?"%cfg.dbname
+    ckstr += " ORDER BY next_try"
+    if limit != None:
+      ckstr += " LIMIT %i"%limit
+    cfg.curs.execute("%s;"%ckstr,(now,))
+    due = cfg.curs.fetchall()
+    id_idx = cfg.dbstruct['id']['index']
+    cfg.curs.executemany("UPDATE %s SET next_try=? WHERE id=?;"%cfg.dbname,
+                         [ (now+outboxlease,row[id_idx]) for row in due ])
+    cfg.dbconn.commit()
+  except:
+    cfg.dbconn.rollback()
+    raise
+  return due
+
+def OutboxStats(cfg,nlatency=100):
+  '''
+    Returns the number of queued emails, the age in seconds of the oldest one
+    and the mean seconds from queuing to sending of the last nlatency sent
+  '''
+  now = time()
+  cfg.curs.execute("SELECT count(*), min(queued) FROM %s WHERE status='queued';"\
+                   %cfg.dbname)
+  depth, oldest = cfg.curs.fetchone()
+  if oldest != None:
+    oldest = now - oldest
+  latstr = "SELECT avg(sent_time-queued) FROM (SELECT * FROM %s"%cfg.dbname
+  latstr += " WHERE status='sent' ORDER BY sent_time DESC LIMIT ?);"
+  cfg.curs.execute(latstr,(nlatency,))
+  latency = cfg.curs.fetchone()[0]
+  return depth, oldest, latency
+
+class smtpworker(threading.Thread):
+  '''
+    Sends emails taken from todo over one SMTP connection, opened when
+    needed, and puts the id, and None or the error, of each on done
+  '''
+  def __init__(self,smtphost,todo,done,dbstruct):
+    threading.Thread.__init__(self)
+    self.daemon = True
+    self.smtphost = smtphost
+    self.todo = todo
+    self.done = done
+    self.dbstruct = dbstruct
+    self.conn = None
+  def send(self,row):
+    msg = MIMEText.MIMEText(row[self.dbstruct['text']['index']])
+    msg['Subject'] = row[self.dbstruct['subject']['index']]
+    msg['From'] = row[self.dbstruct['sender']['index']]
+    msg['To'] = row[self.dbstruct['recipients']['index']]
+    # Reconnect once if the server dropped the connection
+    for i in xrange(2):
+      if self.conn == None:
+        self.conn = smtplib.SMTP(self.smtphost)
+      try:
+        self.conn.sendmail(msg['From'], msg['To'].split(','), msg.as_string())
+        return
+      except smtplib.SMTPServerDisconnected:
+        self.conn = None
+        if i > 0:
+          raise
+  def run(self):
+    while True:
+      row = self.todo.get()
+      if row == None:
+        break
+      try:
+        self.send(row)
+        self.done.put((row,None))
+      except Exception, e:
+        self.close()
+        self.done.put((row,'%s: %s'%(e.__class__.__name__,e)))
+    self.close()
+  def close(self):
+    if self.conn == None:
+      return
+    try:
+      self.conn.quit()
+    except:
+      pass
+    self.conn = None
+
+def Drain(cfg,smtphost,nworkers=2,maxtries=5,backoff=60.):
+  '''
+    Sends the queued emails due using nworkers SMTP connections. An email
+    which fails is retried after backoff seconds, doubled after each
+    attempt, and marked failed after maxtries attempts. Returns the numbers
+    of emails sent, to retry and failed.
+  '''
+  due = Claim(cfg,time())
+  if len(due) == 0:
+    return 0, 0, 0
+  todo = Queue.Queue()
+  done = Queue.Queue()
+  workers = [ smtpworker(smtphost,todo,done,cfg.dbstruct) \
+              for i in xrange(min(nworkers,len(due))) ]
+  for worker in workers:
+    worker.start()
+  for row in due:
+    todo.put(row)
+  for worker in workers:
+    todo.put(None)
+  id_idx = cfg.dbstruct['id']['index']
+  att_idx = cfg.dbstruct['attempts']['index']
+  sent = []
+  retry = []
+  failed = []
+  for i in xrange(len(due)):
+    row, err = done.get()
+    now = time()
+    attempts = row[att_idx] + 1
+    if err == None:
+      sent.append((attempts,now,row[id_idx]))
+      continue
+    logging.error('Failed to send %s (attempt %i): %s'%(row[id_idx],attempts,
+                                                       err))
+    if attempts >= maxtries:
+      failed.append((attempts,err,row[id_idx]))
+    else:
+      retry.append((attempts,err,now + backoff*2**(attempts-1),row[id_idx]))
+  for worker in workers:
+    worker.join()
+  upstr = "UPDATE %s SET"%cfg.dbname
+  cfg.curs.executemany("%s status='sent', attempts=?, sent_time=? WHERE id=?;"\
+                       %upstr,sent)
+  cfg.curs.executemany("%s attempts=?, error=?, next_try=? WHERE id=?;"\
+                       %upstr,retry)
+  cfg.curs.executemany("%s status='failed', attempts=?, error=? WHERE id=?;"\
+                       %upstr,failed)
+  cfg.dbconn.commit()
+  return len(sent), len(retry), len(failed)
+
+if __name__ == "__main__":
+  # Reports the state of the outbox of the alerts DB
+  try:
+    salertdbfname = environ['SALERTDB']
+  except:
+    salertdbfname = '%s/alerts.db'%homedir
+  try:
+    salertdbname = environ['SALERTDBNAME']
+  except:
+    salertdbname = "alerts"
+  cfg = GetOutboxConfig(salertdbfname,'%s_outbox'%salertdbname)
+  if cfg == None:
+    print 'Outbox failed to initialize.'
+    _exit(-1)
+  depth, oldest, latency = OutboxStats(cfg)
+  print 'Queued: %i'%depth
+  if oldest != None:
+    print 'Oldest: %.1f s'%oldest
+  if latency != None:
+    print 'Mean latency: %.1f s'%latency
+  cfg.curs.execute("SELECT status, count(*) FROM %s GROUP BY status;"%cfg.dbname)
+  for status, count in cfg.curs.fetchall():
+    print '%s: %i'%(status,count)
+  cfg.dbconn.close()
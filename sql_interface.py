@@ -7,24 +7,72 @@
 #  Copyright 2011 Brian Baughman. All rights reserved.
 ################################################################################
 import sys, re, time
+from collections import namedtuple
 try:
-  from sqlite3 import connect
+  from sqlite3 import connect, sqlite_version_info, OperationalError, \
+    DatabaseError
 except:
   try:
     from sqlite import connect
+    sqlite_version_info = (0,)
+    OperationalError = Exception
+    DatabaseError = Exception
   except:
     sys.exit(-2)
 from os import environ, access
 
+# sqlite version needed for INSERT ... ON CONFLICT ... RETURNING
+upsertversion = (3,35,0)
+# Status returned by Upsert
+UPSERTNEW = 1
+UPSERTUPDATED = -1
+UPSERTSTALE = -2
+
+# Tuning applied by Connect, by name. WAL lets readers carry on while one
+# process writes, busy_timeout is the milliseconds a statement waits for a
+# lock, cache_size is in pages or, if negative, KiB and mmap_size in bytes.
+dbprofiles = {
+  "default" : { "journal_mode":"wal", "busy_timeout":10000,
+                "synchronous":"normal", "cache_size":-2000, "mmap_size":0 },
+  # Processes adding GCNs, which must not lose a notice to a busy DB
+  "writer" : { "journal_mode":"wal", "busy_timeout":30000,
+               "synchronous":"normal", "cache_size":-2000, "mmap_size":0 },
+  # Processes reading many GCNs
+  "reader" : { "journal_mode":"wal", "busy_timeout":30000,
+               "synchronous":"normal", "cache_size":-32000,
+               "mmap_size":268435456 },
+  # Loading many GCNs at once, a crash may lose the last transactions
+  "bulk" : { "journal_mode":"wal", "busy_timeout":30000,
+             "synchronous":"off", "cache_size":-256000,
+             "mmap_size":268435456 },
+}
+# Attempts Retry makes and seconds it waits before the second, doubled after
+# each
+lockretries = 5
+lockbackoff = 0.1
+# Lock waits retried by Retry and those which failed anyway
+lockstats = { "retries":0, "failures":0, "waited":0. }
+
 attrre = re.compile("^_(.*?)_$")
 datere = re.compile("_date$")
 
 class baseentry(object):
+  # Types of the columns whose default is None, which may be NULL
+  __dbtypes__ = {}
   def __init__(self):
     self.id = "null" # This is a special name and WILL be the primary key
     self.__dbkeys__ = []
     self.__dbstruct__ = None
   def setDBType(self):
+    '''
+      Sets __dbkeys__ and __dbstruct__ from the attributes set by __init__.
+      They are worked out for the first entry of each class and shared by the
+      rest, so they must not be modified.
+    '''
+    cls = self.__class__
+    if '__dbschema__' in cls.__dict__:
+      self.__dbkeys__, self.__dbstruct__ = cls.__dbschema__
+      return
     self.__dbkeys__ = []
     self.__dbstruct__ = {}
     cindx = 0
@@ -32,8 +80,12 @@ class baseentry(object):
       cmatches = attrre.findall(cattr)
       if len(cmatches)>0:
         continue
-      ctype = type(self.__getattribute__(cattr))
+      cval = self.__getattribute__(cattr)
+      ctype = type(cval)
       cnulstat = "NOT NULL"
+      if cval == None and cattr in self.__dbtypes__:
+        ctype = self.__dbtypes__[cattr]
+        cnulstat = ""
       cfmt = "'%s'"
       cdbtype = "BLOB"
       if cattr=="id":
@@ -54,6 +106,7 @@ class baseentry(object):
       self.__dbstruct__[cattr] = { "type":ctype, "dbtype":cdbtype, "fmt":cfmt,
                                    "index":cindx, "nulstat" : cnulstat }
       cindx += 1
+    cls.__dbschema__ = (self.__dbkeys__, self.__dbstruct__)
 
 
 def GetDBStruct(dbcur,dbname):
@@ -62,7 +115,9 @@ def GetDBStruct(dbcur,dbname):
   dbstruct = {}
   for col in tblinfo:
     cattr = col[1]
-    cnulstat = "NOT NULL"
+    cnulstat = ""
+    if col[3]:
+      cnulstat = "NOT NULL"
     cfmt = "'%s'"
     cdbtype = col[2]
     cindx = col[0]
@@ -95,25 +150,234 @@ def GetDBStr(dbname,dbstruct):
     carr[dbstruct[cattr]['index']] = "%s %s %s"%(cattr,cdbtype,cnulstat)
   return "%s%s);"%(dbctbl,','.join(carr))
 
-def GetInsertStr(dbname,dbstruct):
-  carr = []
-  cattrarr = []
+def ConvertValue(val,ctype):
+  '''
+    Returns val as ctype, or None if it is None or does not convert
+  '''
+  if val == None:
+    return None
+  try:
+    return ctype(val)
+  except (TypeError, ValueError):
+    return None
+
+def MigrateDB(curs,dbname,dbstruct,entstruct):
+  '''
+    Converts the columns of dbname whose type in dbstruct, as read by
+    GetDBStruct, differs from that in entstruct, the structure of its entry.
+    sqlite cannot change the type of a column so, in one transaction, the rows
+    are copied, keeping their ids, into a new table which replaces dbname.
+    Values which do not convert become NULL. Indexes and triggers on dbname
+    are dropped with it. Returns the structure of dbname after.
+  '''
+  migkeys = [ cattr for cattr in dbstruct.keys() \
+              if cattr != "id" and cattr in entstruct and \
+              dbstruct[cattr]['dbtype'] != entstruct[cattr]['dbtype'] ]
+  if len(migkeys) == 0:
+    return dbstruct
+  newstruct = {}
   for cattr in dbstruct.keys():
-    cattrarr.append(cattr)
-    carr.append(dbstruct[cattr]['fmt'])
+    newstruct[cattr] = dict(dbstruct[cattr])
+  for cattr in migkeys:
+    for ckey in ["type","dbtype","fmt","nulstat"]:
+      newstruct[cattr][ckey] = entstruct[cattr][ckey]
+  # All columns, id included, in table order
+  ckeys = sorted(newstruct.keys(),key=lambda cattr: newstruct[cattr]['index'])
+  cindx = [ (ckeys.index(cattr),newstruct[cattr]['type']) for cattr in migkeys ]
+  migname = "%s_migrate"%dbname
+  dbconn = curs.connection
+  # Transactions are managed here, the sqlite3 module would commit before
+  # each CREATE, DROP or ALTER
+  isolation = dbconn.isolation_level
+  dbconn.isolation_level = None
+  try:
+    curs.execute("BEGIN IMMEDIATE;")
+    curs.execute("DROP TABLE IF EXISTS %s;"%migname)
+    curs.execute(GetDBStr(migname,newstruct))
+    instr = "INSERT INTO %s (%s) VALUES (%s);"%(migname,','.join(ckeys),
+                                                ','.join(['?']*len(ckeys)))
+    rcurs = dbconn.cursor()
+    rcurs.execute("SELECT %s FROM %s;"%(','.join(ckeys),dbname))
+    while True:
+      rows = rcurs.fetchmany(10000)
+      if len(rows) == 0:
+        break
+      for i in xrange(len(rows)):
+        row = list(rows[i])
+        for j, ctype in cindx:
+          row[j] = ConvertValue(row[j],ctype)
+        rows[i] = row
+      curs.executemany(instr,rows)
+    rcurs.close()
+    curs.execute("DROP TABLE %s;"%dbname)
+    curs.execute("ALTER TABLE %s RENAME TO %s;"%(migname,dbname))
+    curs.execute("COMMIT;")
+  except:
+    err = sys.exc_info()
+    try:
+      curs.execute("ROLLBACK;")
+    except OperationalError:
+      # BEGIN failed, so there is nothing to roll back
+      pass
+    raise err[0], err[1], err[2]
+  finally:
+    dbconn.isolation_level = isolation
+  return GetDBStruct(curs,dbname)
+
+def AddColumns(curs,dbname,dbstruct,newEntry):
+  '''
+    Adds the columns of newEntry missing from dbname, as read by
+    GetDBStruct, with the values of newEntry as their defaults so the
+    existing rows take them. Returns the structure of dbname after.
+  '''
+  entstruct = newEntry.__dbstruct__
+  addkeys = [ cattr for cattr in newEntry.__dbkeys__ if cattr not in dbstruct ]
+  if len(addkeys) == 0:
+    return dbstruct
+  for cattr in addkeys:
+    cval = newEntry.__getattribute__(cattr)
+    cdefault = "NULL"
+    if isinstance(cval,basestring):
+      cdefault = entstruct[cattr]['fmt']%cval.replace("'","''")
+    elif cval != None:
+      cdefault = entstruct[cattr]['fmt']%cval
+    curs.execute("ALTER TABLE %s ADD COLUMN %s %s %s DEFAULT %s;"\
+                 %(dbname,cattr,entstruct[cattr]['dbtype'],
+                   entstruct[cattr]['nulstat'],cdefault))
+  curs.connection.commit()
+  return GetDBStruct(curs,dbname)
+
+def GetDBKeys(dbstruct):
+  '''
+    Returns the columns, other than id, in table order
+  '''
+  ckeys = [ cattr for cattr in dbstruct.keys() if cattr != "id" ]
+  return sorted(ckeys,key=lambda cattr: dbstruct[cattr]['index'])
+
+def GetInsertStr(dbname,dbstruct):
+  '''
+    Returns an insert statement with a placeholder for each column given by
+    GetDBKeys, id is left for sqlite to assign
+  '''
+  cattrarr = GetDBKeys(dbstruct)
   return "INSERT INTO %s (%s) VALUES (%s);"%(dbname,
                                              ','.join(cattrarr),
-                                             ','.join(carr))
+                                             ','.join(['?']*len(cattrarr)))
 
 def GetCheckStr(dbname,dbstruct):
+  '''
+    Returns a select statement with a placeholder for each column given by
+    GetDBKeys
+  '''
   carr = []
-  for cattr in dbstruct.keys():
-    if cattr == "id":
-      continue
-    carr.append("%s=%s"%(cattr,dbstruct[cattr]['fmt']))
+  for cattr in GetDBKeys(dbstruct):
+    carr.append("%s=?"%(cattr))
   return unicode("SELECT * FROM %s WHERE %s;"%(dbname,' and '.join(carr)))
 
+def GetUpdateStr(dbname,upkeys,wherekeys):
+  '''
+    Returns an update statement setting upkeys for rows matching wherekeys.
+    Placeholders are for upkeys followed by wherekeys.
+  '''
+  return "UPDATE %s SET %s WHERE %s;"%(dbname,
+                      ', '.join(['%s=?'%cattr for cattr in upkeys]),
+                      ' and '.join(['%s=?'%cattr for cattr in wherekeys]))
+
+def GetUniqueIndexStr(dbname,ckkeys):
+  return "CREATE UNIQUE INDEX IF NOT EXISTS %s_%s_key ON %s (%s);"%(dbname,
+                                                  '_'.join(ckkeys),
+                                                  dbname,
+                                                  ','.join(ckkeys))
+
+def GetIndexStr(dbname,idxkeys):
+  return "CREATE INDEX IF NOT EXISTS %s_%s_idx ON %s (%s);"%(dbname,
+                                                  '_'.join(idxkeys),
+                                                  dbname,
+                                                  ','.join(idxkeys))
+
+def GetChangeLogStrs(dbname):
+  '''
+    Returns the statements creating dbname_changes, an append only log of
+    the id of each row inserted into or updated in dbname, ordered by seq.
+    Rows already in dbname are logged while the log is empty.
+  '''
+  chgname = "%s_changes"%dbname
+  chgstrs = ["CREATE TABLE IF NOT EXISTS %s (seq INTEGER PRIMARY KEY AUTOINCREMENT, id INTEGER NOT NULL);"%chgname]
+  chgstr = "INSERT INTO %s (id) SELECT id FROM %s"%(chgname,dbname)
+  chgstr += " WHERE NOT EXISTS (SELECT 1 FROM %s) ORDER BY id;"%chgname
+  chgstrs.append(chgstr)
+  for caction in ["INSERT","UPDATE"]:
+    chgstr = "CREATE TRIGGER IF NOT EXISTS %s_%s AFTER %s ON %s"%(chgname,
+                                                                 caction.lower(),
+                                                                 caction,
+                                                                 dbname)
+    chgstr += " BEGIN INSERT INTO %s (id) VALUES (NEW.id); END;"%chgname
+    chgstrs.append(chgstr)
+  return chgstrs
+
+def GetUpsertStr(dbname,dbstruct,ckkeys,upkeys,upcond=None):
+  '''
+    Returns an insert statement which on conflicting ckkeys instead updates
+    upkeys, if upcond holds. Placeholders are as for GetInsertStr. It returns
+    the id of the row and last_insert_rowid() if it inserted or updated.
+  '''
+  upsstr = GetInsertStr(dbname,dbstruct).rstrip(';')
+  upsstr += " ON CONFLICT(%s) DO UPDATE SET %s"%(','.join(ckkeys),
+            ', '.join(['%s=excluded.%s'%(cattr,cattr) for cattr in upkeys]))
+  if upcond != None:
+    upsstr += " WHERE %s"%upcond
+  return upsstr + " RETURNING id, last_insert_rowid();"
+
+def IsLocked(err):
+  '''
+    Returns True if the given exception is sqlite giving up waiting for a lock
+  '''
+  return isinstance(err,OperationalError) and \
+    ('locked' in str(err) or 'busy' in str(err))
+
+def Retry(cfg,func,*args,**kwargs):
+  '''
+    Returns func(*args,**kwargs), which should do a whole transaction on cfg,
+    if given. If the DB stays locked the transaction is rolled back and
+    func run again, up to lockretries times with exponential backoff.
+  '''
+  wait = lockbackoff
+  for attempt in xrange(lockretries):
+    if cfg != None:
+      lastrowid = cfg.lastrowid
+    try:
+      return func(*args,**kwargs)
+    except OperationalError, e:
+      if not IsLocked(e):
+        raise
+      if cfg != None:
+        cfg.dbconn.rollback()
+        cfg.lastrowid = lastrowid
+      if attempt == lockretries - 1:
+        lockstats["failures"] += 1
+        raise
+      lockstats["retries"] += 1
+      lockstats["waited"] += wait
+      time.sleep(wait)
+      wait *= 2
 
+def Connect(dbfname,profile="default"):
+  '''
+    Returns a connection to dbfname tuned as given by dbprofiles[profile]
+  '''
+  conn = connect(dbfname)
+  try:
+    for pragma, value in sorted(dbprofiles[profile].items()):
+      try:
+        conn.execute("PRAGMA %s=%s;"%(pragma,value))
+      except OperationalError, e:
+        # Only tuning, so only a lock is worth waiting for
+        if IsLocked(e):
+          raise
+  except:
+    conn.close()
+    raise
+  return conn
 
 class dbcfg:
   def __init__(self):
@@ -123,25 +387,67 @@ class dbcfg:
     self.curs  = None
     self.dbstruct = None
     self.chkstruct = None
+    self.ckkeys = None
     self.ckstr = None
+    self.instkeys = None
     self.inststr = None
     self.upstruct = None
+    self.upkeys = None
+    self.upstr = None
+    self.upckstr = None
+    self.upsertstr = None
+    self.lastrowid = None
+    self.chgname = None
+    self.skyname = None
+
+def GetConfig(dbfname,dbname,entry,upkeys=None,chkkeys=None,upcond=None,
+              idxkeys=None,changelog=False,profile="default"):
+  '''
+    Returns configuration for given DB. The statements it holds use ?
+    placeholders and are built once so sqlite can reuse them. Values are
+    given in the order of the matching keys:
+      ckstr   - ckkeys
+      inststr - instkeys
+      upstr   - upkeys then id
+      upckstr - upkeys then ckkeys
+    If both upkeys and chkkeys are given a unique index is created on
+    chkkeys and, where sqlite is new enough, upsertstr is set (see Upsert).
+    upcond limits which conflicting rows are updated. An index is created
+    for each list of columns in idxkeys. With changelog set inserts and
+    updates are logged in chgname (see GetChangeLogStrs). The connection is
+    tuned as given by profile (see Connect) and is retried while the DB is
+    locked, returns None on other errors.
+  '''
+  return Retry(None,MakeConfig,dbfname,dbname,entry,upkeys,chkkeys,upcond,
+               idxkeys,changelog,profile)
+
+def Failed(rcfg,err):
+  '''
+    Closes the connection of a configuration which failed. Returns None, or
+    raises err again if the DB was locked so GetConfig retries.
+  '''
+  if rcfg.dbconn != None:
+    rcfg.dbconn.close()
+  if IsLocked(err):
+    raise err
+  return None
 
-def GetConfig(dbfname,dbname,entry,upkeys=None,chkkeys=None):
+def MakeConfig(dbfname,dbname,entry,upkeys,chkkeys,upcond,idxkeys,changelog,
+               profile):
   '''
-    Returns configuration for given DB
+    Does the work of GetConfig, raising OperationalError if the DB is locked
   '''
   rcfg = dbcfg()
   rcfg.dbname = dbname
   # DB interface formats
-  rcfg.dbtblck = "SELECT name FROM sqlite_master WHERE type='table' AND name='%s';"%rcfg.dbname
+  rcfg.dbtblck = "SELECT name FROM sqlite_master WHERE type='table' AND name=?;"
   
 
   # Connect to DB
   try:
-    rcfg.dbconn = connect(dbfname)
+    rcfg.dbconn = Connect(dbfname,profile)
     rcfg.curs = rcfg.dbconn.cursor()
-    rcfg.curs.execute(rcfg.dbtblck)
+    rcfg.curs.execute(rcfg.dbtblck,(rcfg.dbname,))
     dbtblstate = rcfg.curs.fetchone()
     if dbtblstate == None:
       # Get default structure
@@ -151,11 +457,19 @@ def GetConfig(dbfname,dbname,entry,upkeys=None,chkkeys=None):
       dbctbl = GetDBStr(rcfg.dbname,dbstruct)
       rcfg.curs.execute(dbctbl)
       rcfg.dbconn.commit()
-  except:
-    return None
+  except Exception, e:
+    return Failed(rcfg,e)
   
   # Update strcture if DB is different
   rcfg.dbstruct = GetDBStruct(rcfg.curs,rcfg.dbname)
+  # Add columns and convert those whose type was changed since the DB was
+  # made
+  try:
+    rcfg.dbstruct = AddColumns(rcfg.curs,rcfg.dbname,rcfg.dbstruct,entry())
+    rcfg.dbstruct = MigrateDB(rcfg.curs,rcfg.dbname,rcfg.dbstruct,
+                              entry().__dbstruct__)
+  except Exception, e:
+    return Failed(rcfg,e)
   ################################################################################
   
   # Construct check string
@@ -165,47 +479,188 @@ def GetConfig(dbfname,dbname,entry,upkeys=None,chkkeys=None):
   if  chkkeys != None:
     for cattr in chkkeys:
       rcfg.chkstruct[cattr] = rcfg.dbstruct[cattr]
+    rcfg.ckkeys = GetDBKeys(rcfg.chkstruct)
     rcfg.ckstr = GetCheckStr(rcfg.dbname,rcfg.chkstruct)
   
   # Construct insert string
+  rcfg.instkeys = GetDBKeys(rcfg.dbstruct)
   rcfg.inststr = GetInsertStr(rcfg.dbname,rcfg.dbstruct)
   
   rcfg.upstruct = {}
   if upkeys != None:
+    rcfg.upkeys = list(upkeys)
     for cattr in upkeys:
       rcfg.upstruct[cattr] = rcfg.dbstruct[cattr]
+    rcfg.upstr = GetUpdateStr(rcfg.dbname,rcfg.upkeys,["id"])
+    if chkkeys != None:
+      rcfg.upckstr = GetUpdateStr(rcfg.dbname,rcfg.upkeys,rcfg.ckkeys)
+      try:
+        rcfg.curs.execute(GetUniqueIndexStr(rcfg.dbname,rcfg.ckkeys))
+        rcfg.dbconn.commit()
+        if sqlite_version_info >= upsertversion:
+          rcfg.upsertstr = GetUpsertStr(rcfg.dbname,rcfg.dbstruct,
+                                        rcfg.ckkeys,rcfg.upkeys,upcond)
+      except Exception, e:
+        # Existing duplicates prevent the index, the caller must check first
+        if IsLocked(e):
+          return Failed(rcfg,e)
+        rcfg.dbconn.rollback()
+  if idxkeys != None:
+    try:
+      for cidxkeys in idxkeys:
+        rcfg.curs.execute(GetIndexStr(rcfg.dbname,cidxkeys))
+      rcfg.dbconn.commit()
+    except Exception, e:
+      return Failed(rcfg,e)
+  if changelog:
+    try:
+      for chgstr in GetChangeLogStrs(rcfg.dbname):
+        rcfg.curs.execute(chgstr)
+      rcfg.dbconn.commit()
+    except Exception, e:
+      return Failed(rcfg,e)
+    rcfg.chgname = "%s_changes"%rcfg.dbname
   return rcfg
 
+def LastChange(cfg):
+  '''
+    Returns the seq of the most recent change logged, or 0
+  '''
+  cfg.curs.execute("SELECT max(seq) FROM %s;"%cfg.chgname)
+  lastseq = cfg.curs.fetchone()[0]
+  if lastseq == None:
+    return 0
+  return lastseq
+
+def QueryPlan(curs,qstr,qargs=()):
+  '''
+    Returns sqlite's description of how it will run the given query, e.g.
+    which index, if any, it uses.
+  '''
+  curs.execute("EXPLAIN QUERY PLAN %s"%qstr,qargs)
+  return [ str(row[-1]) for row in curs.fetchall() ]
+
+def Upsert(cfg,carr):
+  '''
+    Inserts carr, ordered as cfg.instkeys, or updates the existing row with
+    the same cfg.ckkeys values in a single statement, without committing.
+    Returns the row id and UPSERTNEW, UPSERTUPDATED or UPSERTSTALE (if
+    upcond did not hold).
+  '''
+  cfg.curs.execute(cfg.upsertstr,carr)
+  rply = cfg.curs.fetchall()
+  if len(rply) == 0:
+    ckarr = [ carr[cfg.instkeys.index(cattr)] for cattr in cfg.ckkeys ]
+    cfg.curs.execute(cfg.ckstr,ckarr)
+    return cfg.curs.fetchone()[cfg.dbstruct['id']['index']], UPSERTSTALE
+  # Some sqlite versions return the ids from RETURNING as REAL
+  rid, lastrowid = [ int(cid) for cid in rply[0] ]
+  # An update leaves last_insert_rowid() alone, so the row was only inserted
+  # now if it is the last one inserted and was not so before this statement.
+  isnew = rid == lastrowid and rid != cfg.lastrowid
+  cfg.lastrowid = lastrowid
+  if isnew:
+    return rid, UPSERTNEW
+  return rid, UPSERTUPDATED
+
+def InsertMany(cfg,rows):
+  '''
+    Inserts rows, tuples ordered as cfg.instkeys, without committing
+  '''
+  cfg.curs.executemany(cfg.inststr,rows)
+  # Keep track of last_insert_rowid() for Upsert
+  cfg.curs.execute("SELECT last_insert_rowid();")
+  cfg.lastrowid = cfg.curs.fetchone()[0]
+
+def CheckMany(cfg,keys):
+  '''
+    Returns the rows matching each tuple of keys, ordered as cfg.ckkeys.
+    sqlite cannot return rows from executemany so the one prepared check
+    statement is run for each.
+  '''
+  mtchs = []
+  for ckey in keys:
+    cfg.curs.execute(cfg.ckstr,ckey)
+    mtchs.append(cfg.curs.fetchall())
+  return mtchs
+
+def UpdateMany(cfg,rows,bykey=False):
+  '''
+    Updates rows without committing. Rows are tuples of the cfg.upkeys values
+    followed by the id, or by the cfg.ckkeys values if bykey is set.
+  '''
+  if bykey:
+    cfg.curs.executemany(cfg.upckstr,rows)
+  else:
+    cfg.curs.executemany(cfg.upstr,rows)
+
 def Check(curs,dbname,curEntry):
-  carr = []
-  for cattr in curEntry.__dbkeys__:
-    if cattr == "id":
-      continue
-    carr.append(curEntry.__getattribute__(cattr))
-  chkstr = GetCheckStr(dbname,curEntry.__dbstruct__)%tuple(carr)
-  curs.execute(newchk)
+  carr = [ curEntry.__getattribute__(cattr) \
+           for cattr in GetDBKeys(curEntry.__dbstruct__) ]
+  chkstr = GetCheckStr(dbname,curEntry.__dbstruct__)
+  curs.execute(chkstr,carr)
   rply = curs.fetchall()
   return len(rply)
 
 def UpdateDB(curs,dbname,curEntry):
   if Check(curs,dbname,curEntry) == 0:
-    carr = [curEntry.__getattribute__(cattr) for cattr in curEntry.__dbkeys__ ]
-    newent = GetInsertStr(dbname,curEntry.__dbstruct__)%tuple(carr)
-    curs.execute(newent)
+    carr = [ curEntry.__getattribute__(cattr) \
+             for cattr in GetDBKeys(curEntry.__dbstruct__) ]
+    newent = GetInsertStr(dbname,curEntry.__dbstruct__)
+    curs.execute(newent,carr)
     return
 
+# Classes made by RowType keyed on entry class and columns
+rowtypes = {}
+# The same keyed on entry class and dbstruct, which is held so its id is not
+# reused
+rowtypesbystruct = {}
+
+def RowType(entry,dbstruct):
+  '''
+    Returns a read only, tuple backed class for rows of entry with the
+    columns in dbstruct, made once for each. Columns are also attributes and
+    attributes of entry which are not columns have their defaults.
+  '''
+  try:
+    return rowtypesbystruct[(entry,id(dbstruct))][1]
+  except KeyError:
+    pass
+  ckeys = tuple(sorted(dbstruct.keys(),key=lambda cattr: dbstruct[cattr]['index']))
+  rkey = (entry,ckeys)
+  if rkey not in rowtypes:
+    defaults = dict([ (cattr,cval) for cattr,cval in entry().__dict__.items() \
+                      if cattr not in ckeys and len(attrre.findall(cattr)) == 0 ])
+    defaults['__slots__'] = ()
+    defaults['__dbstruct__'] = dbstruct
+    defaults['__dbkeys__'] = list(ckeys)
+    rowtypes[rkey] = type('%srow'%entry.__name__,
+                          (namedtuple('%stuple'%entry.__name__,ckeys),),
+                          defaults)
+  rowtypesbystruct[(entry,id(dbstruct))] = (dbstruct,rowtypes[rkey])
+  return rowtypes[rkey]
+
 def MakeEntry(dbrow,entry,dbstruct):
-  newEntry = entry()
-  for cattr in dbstruct.keys():
-    newEntry.__setattr__(cattr,dbrow[dbstruct[cattr]['index']])
-  newEntry.__dbstruct__ = dbstruct
-  newEntry.__dbkeys__ = dbstruct.keys()
-  return newEntry
+  '''
+    Returns the leading columns of dbrow, given by dbstruct, as a row of
+    RowType(entry,dbstruct)
+  '''
+  return tuple.__new__(RowType(entry,dbstruct),dbrow[:len(dbstruct)])
+
+def RowCursor(cfg,entry):
+  '''
+    Returns a new cursor on cfg whose rows, which must be whole rows of
+    cfg.dbname, are made as rows of RowType(entry,cfg.dbstruct)
+  '''
+  rtype = RowType(entry,cfg.dbstruct)
+  curs = cfg.dbconn.cursor()
+  curs.row_factory = lambda curs,row: tuple.__new__(rtype,row)
+  return curs
 
 def CheckDB(dbcurs,dbname,dbstruct):
-  dbtblchk = "SELECT name FROM sqlite_master WHERE type='table' AND name='%s';"%dbname
+  dbtblchk = "SELECT name FROM sqlite_master WHERE type='table' AND name=?;"
   try:
-    dbcurs.execute(dbtblchk)
+    dbcurs.execute(dbtblchk,(dbname,))
     dbtblstate = dbcurs.fetchone()
     if dbtblstate == None:
       dbctbl = GetDBStr(dbname,dbstruct)
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+################################################################################
+#  test_gcn_dbinterface.py
+#  Regression tests of writing GCNs in bulk.
+#
+#  Run as python -m unittest test_gcn_dbinterface
+################################################################################
+try:
+  import unittest, tempfile, shutil
+  from os import path
+  from gcn_dbinterface import gcninfo, GCNRow, GetGCNConfig, AddGCNs, \
+    LoadGCNs, ConeSearch
+except:
+  print 'Failed to load modules'
+  raise
+
+def MakeRow(trigid,updated_date='2013-03-01 12:01:00',**kwargs):
+  '''
+    Returns the row of a GCN with the given trigid and columns
+  '''
+  newgcn = gcninfo()
+  newgcn.trigid = trigid
+  newgcn.trig_tjd = 16352
+  newgcn.updated_date = updated_date
+  newgcn.ra = 123.4
+  newgcn.dec = -12.3
+  newgcn.error = 1.
+  for cattr, cval in kwargs.items():
+    newgcn.__setattr__(cattr,cval)
+  return GCNRow(newgcn)
+
+class BulkAdd(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.cfg = GetGCNConfig(path.join(self.tmpdir,'gcns.db'),'gcns','bulk')
+    self.assertNotEqual(self.cfg,None)
+
+  def tearDown(self):
+    self.cfg.dbconn.close()
+    shutil.rmtree(self.tmpdir)
+
+  def testOrder(self):
+    trigids = [ str(i) for i in xrange(100,0,-1) ]
+    AddGCNs([ MakeRow(trigid) for trigid in trigids ],self.cfg)
+    self.assertEqual([ gcn.trigid for gcn in LoadGCNs(self.cfg) ],trigids)
+
+  def testReject(self):
+    rows = [ MakeRow('1'), MakeRow('2',intenunit=None), MakeRow('3'),
+             MakeRow('1',updated_date='2013-03-01 12:02:00') ]
+    rejects = []
+    ninst, nupd = AddGCNs(rows,self.cfg,rejects=rejects)
+    self.assertEqual((ninst,nupd),(2,0))
+    self.assertEqual([ row for row, err in rejects ],[rows[1]])
+    gcns = LoadGCNs(self.cfg)
+    self.assertEqual([ gcn.trigid for gcn in gcns ],['1','3'])
+    self.assertEqual(gcns[0].updated_date,'2013-03-01 12:02:00')
+    # The rejected GCN is not indexed, the others are
+    self.assertEqual(sorted(ConeSearch(self.cfg,123.4,-12.3,1.)[0]),
+                     [ gcn.id for gcn in gcns ])
+    # Nor taken as known, so it is added once fixed
+    ninst, nupd = AddGCNs([MakeRow('2'),MakeRow('3')],self.cfg)
+    self.assertEqual((ninst,nupd),(1,0))
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,56 @@
+#!/usr/bin/env python
+################################################################################
+#  test_gcn_events.py
+#  Regression tests of sending GCN changed events to gcn-alertd.
+#
+#  Run as python -m unittest test_gcn_events
+################################################################################
+try:
+  import unittest, tempfile, shutil, socket
+  from os import path
+  from gcn_events import Notify, Listen, Events
+except:
+  print 'Failed to load modules'
+  raise
+
+class NotifyTest(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.sockname = path.join(self.tmpdir,'alert.sock')
+
+  def tearDown(self):
+    shutil.rmtree(self.tmpdir)
+
+  def testListening(self):
+    srv = Listen(self.sockname)
+    try:
+      self.assertTrue(Notify(self.sockname,-7,'100',16352))
+      self.assertEqual(Events(srv,1.),[(7,'100','16352')])
+      # Events waiting fill the socket, later ones count as delivered
+      for i in xrange(10000):
+        self.assertTrue(Notify(self.sockname,i,'100',16352))
+    finally:
+      srv.close()
+
+  def testNotListening(self):
+    self.assertFalse(Notify(self.sockname,7,'100',16352))
+    # Left behind by gcn-alertd
+    Listen(self.sockname).close()
+    self.assertFalse(Notify(self.sockname,7,'100',16352))
+
+  def testNotDatagram(self):
+    srv = socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    srv.bind(self.sockname)
+    srv.listen(1)
+    try:
+      self.assertFalse(Notify(self.sockname,7,'100',16352))
+    finally:
+      srv.close()
+
+  def testNotSocket(self):
+    open(self.sockname,'w').close()
+    self.assertFalse(Notify(self.sockname,7,'100',16352))
+
+
+if __name__ == "__main__":
+  unittest.main()
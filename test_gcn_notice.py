@@ -0,0 +1,84 @@
+#!/usr/bin/env python
+################################################################################
+#  test_gcn_notice.py
+#  Regression tests of parsing notices and adding them to a GCN DB.
+#
+#  Run as python -m unittest test_gcn_notice
+################################################################################
+try:
+  import unittest, tempfile, shutil
+  from os import path
+  from gcn_notice import ParseNotice
+  from gcn_dbinterface import GetGCNConfig, AddGCN, LoadGCNs
+  from sql_interface import UPSERTNEW, UPSERTSTALE
+except:
+  print 'Failed to load modules'
+  raise
+
+# Fermi-GBM notice without a Burst_Inten Param
+noticefmt = '''From: vo@gcn
+Subject: notice
+
+<?xml version = '1.0' encoding = 'UTF-8'?>
+<voe:VOEvent ivorn="ivo://nasa.gsfc.gcn/Fermi#GBM" role="observation" version="2.0" xmlns:voe="http://www.ivoa.net/xml/VOEvent/v2.0">
+<Who><Date>2013-03-01T12:01:00</Date></Who>
+<What>
+<Param name="Packet_Type" value="112" />
+<Param name="TrigID" value="%s" />
+<Param name="Burst_TJD" value="16352" />
+<Param name="Burst_SOD" value="43200.5" />
+<Group name="Trigger_ID"><Param name="Def_NOT_a_GRB" value="false" /></Group>
+<Description>Fermi-GBM Flight-position notice</Description>
+</What>
+<WhereWhen><ObsDataLocation><ObservatoryLocation id="GEOLUN" /><ObservationLocation>
+<AstroCoordSystem id="UTC-FK5-GEO" />
+<AstroCoords coord_system_id="UTC-FK5-GEO">
+<Time unit="s"><TimeInstant><ISOTime>2013-03-01T12:00:00.00</ISOTime></TimeInstant></Time>
+<Position2D unit="deg"><Name1>RA</Name1><Name2>Dec</Name2>
+<Value2><C1>123.4</C1><C2>-12.3</C2></Value2><Error2Radius>5.0</Error2Radius></Position2D>
+</AstroCoords></ObservationLocation></ObsDataLocation></WhereWhen>
+</voe:VOEvent>
+'''
+
+class NoInten(unittest.TestCase):
+  def setUp(self):
+    self.tmpdir = tempfile.mkdtemp()
+    self.cfg = GetGCNConfig(path.join(self.tmpdir,'gcns.db'),'gcns')
+    self.assertNotEqual(self.cfg,None)
+
+  def tearDown(self):
+    self.cfg.dbconn.close()
+    shutil.rmtree(self.tmpdir)
+
+  def testParse(self):
+    newgcn, perr = ParseNotice(noticefmt%'100')
+    self.assertEqual(perr,None)
+    self.assertEqual(newgcn.inten,None)
+    self.assertEqual(newgcn.intenunit,'unset')
+    self.assertEqual(newgcn.trigid,'100')
+
+  def testAdd(self):
+    newgcn, perr = ParseNotice(noticefmt%'100')
+    id, status = AddGCN(newgcn,self.cfg)
+    self.assertEqual(status,UPSERTNEW)
+    self.assertTrue(isinstance(id,(int,long)))
+    # The same notice again matches the stored GCN
+    id, status = AddGCN(newgcn,self.cfg)
+    self.assertEqual(status,UPSERTSTALE)
+    gcns = LoadGCNs(self.cfg)
+    self.assertEqual(len(gcns),1)
+    self.assertEqual(gcns[0].inten,None)
+    self.assertEqual(gcns[0].intenunit,'unset')
+
+  def testNoTrigID(self):
+    newgcn, perr = ParseNotice(noticefmt.replace('<Param name="TrigID"',
+                                                 '<Param name="NoTrigID"')%'')
+    self.assertEqual(newgcn.trigid,'unset')
+    AddGCN(newgcn,self.cfg)
+    id, status = AddGCN(newgcn,self.cfg)
+    self.assertEqual(status,UPSERTSTALE)
+    self.assertEqual(len(LoadGCNs(self.cfg)),1)
+
+
+if __name__ == "__main__":
+  unittest.main()
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+################################################################################
+#  test_site_alerter.py
+#  Regression tests of the alerts sent by site-alerter.
+#
+#  Run as python -m unittest test_site_alerter
+################################################################################
+try:
+  import unittest, tempfile, shutil, logging
+  from os import environ, path, makedirs
+  from datetime import datetime, timedelta
+  # site_alerter reads its settings once imported
+  tmpdir = tempfile.mkdtemp()
+  environ['HOME'] = tmpdir
+  environ['GCNDB'] = path.join(tmpdir,'gcns.db')
+  environ['SALERTDB'] = path.join(tmpdir,'alerts.db')
+  environ['GCNWEB'] = path.join(tmpdir,'web')
+  environ['GCNHTTP'] = 'http://localhost'
+  # Emails are queued in the outbox, nothing listens to send them
+  environ['GCNSMTP'] = 'localhost:1'
+  environ['SALERTCFG'] = path.join(tmpdir,'salertcfg')
+  environ['BITLYAPI'] = path.join(tmpdir,'.bitlyapi')
+  for cvar in ['GCNSITES','GCNFORECAST','GCNMANIFEST']:
+    environ.pop(cvar,None)
+  makedirs(environ['GCNWEB'])
+  open(environ['SALERTCFG'],'w').write('gcn@localhost\nsite@localhost\n')
+  # Which is logged as an error
+  logging.disable(logging.CRITICAL)
+  from numpy import arange, zeros, rad2deg, deg2rad, flatnonzero
+  from timeConv import dttm2jd, TJD0
+  from coordConv import eq2horzTJD
+  import site_alerter
+  from site_alerter import SiteAlerter
+  from gcn_dbinterface import gcninfo, GetGCNConfig, AddGCN
+except:
+  print 'Failed to load modules'
+  raise
+
+def Zenith(tjd,ras,dec):
+  '''
+    Returns the zenith angles at the site of the given positions, in degrees
+  '''
+  alt, az = eq2horzTJD(site_alerter.obslat,site_alerter.obslon,
+                       tjd + zeros(len(ras)),deg2rad(ras),
+                       deg2rad(dec + zeros(len(ras))))
+  return 90. - rad2deg(alt)
+
+class EnteringFOV(unittest.TestCase):
+  def setUp(self):
+    self.gcncfg = GetGCNConfig(site_alerter.gcndbfname,site_alerter.gcndbname)
+    self.alerter = SiteAlerter()
+    self.assertEqual(self.alerter.Open(),0)
+
+  def tearDown(self):
+    self.alerter.Close()
+    self.gcncfg.dbconn.close()
+
+  def AddGCN(self,trig,ra,dec,updated,trigid='900'):
+    newgcn = gcninfo()
+    newgcn.trigid = trigid
+    newgcn.trig_tjd = int(trig)
+    newgcn.trig_sod = (trig - int(trig))*86400.
+    newgcn.updated_date = updated.strftime('%Y-%m-%d %H:%M:%S')
+    newgcn.ra = ra
+    newgcn.dec = dec
+    newgcn.error = 0.1
+    AddGCN(newgcn,self.gcncfg)
+
+  def Windows(self):
+    curs = self.alerter.alertdbcfg.curs
+    curs.execute("SELECT rise_tjd, set_tjd, sent FROM %s;"\
+                 %self.alerter.windbname)
+    return curs.fetchall()
+
+  def Entering(self):
+    '''
+      Returns the subjects of the entering FOV emails queued
+    '''
+    curs = self.alerter.outboxcfg.curs
+    curs.execute("SELECT subject FROM %s ORDER BY id;"\
+                 %self.alerter.outboxcfg.dbname)
+    return [ row[0] for row in curs.fetchall() if 'entering FOV' in row[0] ]
+
+  def testManifest(self):
+    manifestfname = site_alerter.manifestfname
+    self.assertFalse(manifestfname.startswith(site_alerter.gcnweb))
+    # GCNs without a position, never in the FOV
+    now = datetime.utcnow()
+    self.AddGCN(dttm2jd(now) - TJD0,None,None,now,'800')
+    self.alerter.Run()
+    self.assertFalse(path.exists(manifestfname))
+    # Only kept for site-alerter-daemon
+    pushed = SiteAlerter(manifest=True)
+    self.assertEqual(pushed.Open(),0)
+    try:
+      self.AddGCN(dttm2jd(now) - TJD0,None,None,now,'801')
+      pushed.Run()
+    finally:
+      pushed.Close()
+    self.assertEqual(len(site_alerter.ManifestRead()[0]),1)
+
+  def testUpdate(self):
+    now = datetime.utcnow()
+    nowtjd = dttm2jd(now) - TJD0
+    trig = nowtjd - 3./24.
+    # A position which rose into the FOV about an hour ago
+    dec = rad2deg(site_alerter.obslat)
+    ras = arange(0.,360.,0.05)
+    zrise = Zenith(nowtjd - 1./24.,ras,dec)
+    rising = flatnonzero((zrise >= 45.) & (zrise < 46.) & \
+                         (Zenith(nowtjd,ras,dec) < zrise) & \
+                         (Zenith(trig,ras,dec) > 45.))
+    ra = ras[rising[0]]
+    self.AddGCN(trig,ra,dec,now - timedelta(minutes=10))
+    self.alerter.Run()
+    windows = self.Windows()
+    self.assertEqual(len(windows),1)
+    self.assertEqual(windows[0][2],1)
+    self.assertEqual(len(self.Entering()),1)
+    rise = windows[0][0]
+    # A small update of the position must not alert on the window again
+    self.AddGCN(trig,ra + 0.05,dec,now - timedelta(minutes=5))
+    self.alerter.Run()
+    windows = self.Windows()
+    self.assertEqual(len(windows),1)
+    # Forecast again for the new position
+    self.assertNotEqual(windows[0][0],rise)
+    self.assertEqual(windows[0][2],1)
+    self.assertEqual(len(self.Entering()),1)
+
+
+def tearDownModule():
+  shutil.rmtree(tmpdir)
+
+if __name__ == "__main__":
+  unittest.main()
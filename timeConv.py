@@ -5,7 +5,7 @@
 #
 #  Created by Brian Baughman on 2014/04/30.
 ################################################################################
-from numpy import  pi, remainder, floor
+from numpy import  pi, remainder, floor, asarray
 from datetime import datetime, time, timedelta
 
 
@@ -79,6 +79,33 @@ def dttm2LST(doi,lon=0.):
   sidOff = 24.*((lon/nrm)*sid2sol)
   return remainder(GMST+sidOff,24.)
 
+def tjd2GMST(tjd):
+  '''
+  Given a truncated Julian day, or a numpy array of them, returns the
+  Greenwich mean sidereal time (GMST) in hours as dttm2GMST does, without
+  building a datetime for each.
+  '''
+  tjd = asarray(tjd,dtype=float)
+  # Truncated Julian days start at midnight UTC
+  tjd0 = floor(tjd)
+  H = 24.*(tjd - tjd0)
+  D0 = tjd0 + TJD0 - J2000JD
+  D = tjd + TJD0 - J2000JD
+  T = D/36525.
+  return 6.697374558 + 0.06570982441908*D0 + 1.00273790935*H + 0.000026*T**2
+
+def tjd2LST(tjd,lon=0.):
+  '''
+  Given a truncated Julian day, or a numpy array of them, and a longitude
+  returns the Local Sidereal Time (LST) as dttm2LST does.
+  tjd - truncated Julian day of interest
+  lon - longitude in radians
+  '''
+  nrm = 2.*pi
+  GMST = tjd2GMST(tjd)
+  sidOff = 24.*((lon/nrm)*sid2sol)
+  return remainder(GMST+sidOff,24.)
+
 def ST2tm(ST):
   '''
   Given an Sidereal time in hours outputs a time object for easy reading